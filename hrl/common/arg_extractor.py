@@ -53,6 +53,26 @@ def get_train_args():
             help="A small description of the experiment")
     parser.add_argument('--not_save', action='store_true', 
             help="True means not saving the experiment")
+    parser.add_argument('--backend', type=str,
+            help="The backend used to run the sub-policies of high level \
+                    environments, e.g. tf, graph, numpy, float16, int8 or mmap. Default: tf")
+    parser.add_argument('--inference_server', action='store_true',
+            help="Run the sub-policies of all the workers in one process \
+                    that batches their predictions, --backend is the backend \
+                    used by that process. Default backend: numpy")
+    parser.add_argument('--track_pool', type=str,
+            help="Folder of tracks (e.g. tracks) or archive loaded once in shared memory \
+                    and used by all the workers instead of the .pkl files")
+    parser.add_argument('--episodes_per_track', type=int,
+            help="Number of episodes run in the same track before loading \
+                    a new one, the others only place the car again. Default: 1")
+    parser.add_argument('--world_pool_size', type=int,
+            help="Number of Box2D worlds of previous tracks kept by each \
+                    worker, drawing one of those tracks again does not \
+                    rebuild it. Default: 0")
+    parser.add_argument('--multi_car', action='store_true',
+            help="Drive env_num cars in the same track and Box2D world in \
+                    one process instead of one env per worker")
     args = parser.parse_args()
 
     args = vars(args)
@@ -111,6 +131,18 @@ def get_load_args():
     parser.add_argument('--no_render', action='store_true',
             help="In case you want to log some info, but do not care about \
             rendering in screen")
+    parser.add_argument('--backend', type=str,
+            help="The backend used to run the sub-policies of high level \
+            environments, e.g. tf, graph, numpy, float16, int8 or mmap. Default: tf")
+    parser.add_argument('--interrupt_mode', type=str,
+            help="When interrupting policies ask the top level model, \
+            step (every step), k (every --interrupt_k steps) or tile (when \
+            the car changes tile). Default: step")
+    parser.add_argument('--interrupt_k', type=int,
+            help="The number of steps between checks in k mode. Default: 4")
+    parser.add_argument('--record_obs', type=str,
+            help="Path of a .npy file where the observations seen by the \
+            model are saved, e.g. to check the accuracy of converted weights")
 
     args = parser.parse_args()
 
@@ -139,6 +171,73 @@ def get_track_generator_args():
 
     return args
 
+def get_track_intersections_args():
+    parser = argparse.ArgumentParser(
+        description='This will parse the argument used to add the \
+                intersections table to the tracks')
+
+    parser.add_argument('--folder', '-f', type=str, default='tracks',
+            help="The folder with the tracks and list.csv. Default: tracks")
+    parser.add_argument('--overwrite', action='store_true',
+            help="Recompute the table of the tracks that already have one")
+    args = parser.parse_args()
+
+    return args
+
+def get_convert_tracks_args():
+    parser = argparse.ArgumentParser(
+        description='This will parse the argument used to pack the tracks \
+                in an archive')
+
+    parser.add_argument('--folder', '-f', type=str, default='tracks',
+            help="The folder with the tracks and list.csv. Default: tracks")
+    parser.add_argument('--output', '-o', type=str,
+            help="The archive to write. Default: <folder>.tracks")
+    parser.add_argument('--keep_dtype', action='store_true',
+            help="Keep the dtype of the track arrays instead of float32")
+    args = parser.parse_args()
+
+    return args
+
+def get_check_renderer_args():
+    parser = argparse.ArgumentParser(
+        description='This will parse the argument used to compare the \
+                software renderer with the GL frames')
+
+    parser.add_argument('--env', '-e', type=str, default='Base',
+            help="The env to use. Default: Base")
+    parser.add_argument('--steps', '-s', type=int, default=500,
+            help="Number of steps with random actions. Default: 500")
+    parser.add_argument('--pixel_tolerance', type=int, default=8,
+            help="Max difference (0-255) of a pixel to be considered equal. \
+            Default: 8")
+    parser.add_argument('--tolerance', '-t', type=float, default=0.02,
+            help="Max fraction of different pixels per frame. Default: 0.02")
+    args = parser.parse_args()
+
+    return args
+
+def get_convert_weights_args():
+    parser = argparse.ArgumentParser(
+        description='This will parse the argument used to convert the \
+                weights of the policies')
+
+    parser.add_argument('--weights', '-w', type=str, default='hrl/weights',
+            help="A .pkl file or a folder, every .pkl inside the folder \
+            is converted. Default: hrl/weights")
+    parser.add_argument('--precision', '-p', type=str, default='float16',
+            help="float16 or int8. Default: float16")
+    parser.add_argument('--check', '-c', type=str,
+            help="A .npy file with recorded observations, the agreement of \
+            the actions with the float32 model is reported")
+    parser.add_argument('--mmap', action='store_true',
+            help="Write the float32 weights as a memory mapped .npy arena \
+            with a .json manifest instead of reducing the precision, used \
+            by the mmap backend")
+    args = parser.parse_args()
+
+    return args
+
 def get_env_args():
     parser = argparse.ArgumentParser(
         description='This will parse the argument used in \
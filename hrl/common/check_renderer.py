@@ -0,0 +1,43 @@
+import numpy as np
+
+from hrl.envs import env as environments
+from hrl.common.arg_extractor import get_check_renderer_args
+
+
+def check_renderer(env='Base',steps=500,pixel_tolerance=8,tolerance=0.02):
+    """
+    Runs env with the GL observations and random actions and compares every
+    frame with the one of SoftwareRenderer for the same state, raises an
+    AssertionError if the fraction of pixels differing by more than
+    pixel_tolerance is above tolerance in any frame
+    """
+    env = getattr(environments,env)(observation_backend='gl')
+    env.reset()
+
+    differences = []
+    for _ in range(steps):
+        _,_,done,_ = env.step(env.action_space.sample())
+        gl_frame = env.render('state_pixels').astype(np.int16)
+        sw_frame = env.software_renderer.render().astype(np.int16)
+        different = (np.abs(gl_frame - sw_frame) > pixel_tolerance).any(axis=-1)
+        differences.append(different.mean())
+        if done:
+            env.reset()
+    env.close()
+
+    differences = np.array(differences)
+    print("Different pixels per frame: mean %.4f, max %.4f" \
+            % (differences.mean(),differences.max()))
+    assert differences.max() <= tolerance, \
+            "The software renderer differs from GL in %.4f of the pixels" \
+            % differences.max()
+    return differences
+
+
+if __name__=='__main__':
+    args = get_check_renderer_args()
+    check_renderer(
+            env=args.env,
+            steps=args.steps,
+            pixel_tolerance=args.pixel_tolerance,
+            tolerance=args.tolerance)
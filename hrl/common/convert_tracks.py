@@ -0,0 +1,35 @@
+import os
+import pickle
+
+import numpy as np
+
+from hrl.envs.track_pool import pack_tracks, TrackPool
+from hrl.common.arg_extractor import get_convert_tracks_args
+
+
+def convert_tracks(folder='tracks',output=None,keep_dtype=False):
+    """
+    Packs the tracks of folder in a single archive, Base can load it with
+    load_tracks_from=<archive>
+    """
+    if output is None:
+        output = os.path.normpath(folder) + '.tracks'
+    dtype = None if keep_dtype else np.float32
+    pack_tracks(folder,output,dtype=dtype)
+
+    pool = TrackPool(output)
+    # The packed tracks must be the ones of folder, up to the dtype
+    for idx in pool.tracks_df.index:
+        with open(os.path.join(folder,str(idx) + '.pkl'),'rb') as f:
+            track = np.asarray(pickle.load(f)['track'])
+        packed = pool.get(idx)['track']
+        assert packed.shape == track.shape and np.allclose(packed,track.astype(packed.dtype)), \
+                "The track %s in %s does not match %s" % (idx,output,folder)
+    print("%i tracks (%i tiles) saved in %s, %.1f MB" % (len(pool),len(pool.info),
+            output,os.path.getsize(output)/2**20))
+    return output
+
+
+if __name__=='__main__':
+    args = get_convert_tracks_args()
+    convert_tracks(folder=args.folder,output=args.output,keep_dtype=args.keep_dtype)
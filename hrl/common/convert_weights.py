@@ -0,0 +1,42 @@
+import glob
+import os
+
+import numpy as np
+
+from hrl.common.arg_extractor import get_convert_weights_args
+from hrl.policies.quantize import save_quantized, check_agreement
+from hrl.policies.weight_store import convert_to_store
+
+def convert_weights(weights='hrl/weights',precision='float16',check=None,mmap=False):
+    if os.path.isdir(weights):
+        files = sorted(glob.glob(os.path.join(weights,'**','*.pkl'),recursive=True))
+    else:
+        files = [weights]
+
+    observations = None
+    if check is not None:
+        observations = np.load(check)
+
+    for w in files:
+        if mmap:
+            path,_ = convert_to_store(w)
+            print("%s -> %s" % (w,path))
+            continue
+
+        path = save_quantized(w,precision)
+        before = os.path.getsize(w) / 2**20
+        after = os.path.getsize(path) / 2**20
+        print("%s -> %s (%.1fMB -> %.1fMB)" % (w,path,before,after))
+
+        if observations is not None:
+            agreement = check_agreement(w,precision,observations)
+            print("    actions agree with float32 in %.2f%% of %i observations" \
+                    % (agreement*100,len(observations)))
+
+if __name__=='__main__':
+    args = get_convert_weights_args()
+    convert_weights(
+            weights=args.weights,
+            precision=args.precision,
+            check=args.check,
+            mmap=args.mmap)
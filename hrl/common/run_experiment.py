@@ -17,6 +17,9 @@ from pynput.keyboard import Key, Listener, KeyCode
 from hrl.common.arg_extractor import get_train_args
 from hrl.common.utils import create_experiment_folder,remove_experiment
 from hrl.envs import env as environments
+from hrl.policies.server import start_server, stop_server
+from hrl.envs.track_pool import create_track_pool, remove_track_pool, is_track_archive
+from hrl.envs.multi_car import MultiCarEnv
 
 def run_experiment(
         not_save=False, 
@@ -33,6 +36,12 @@ def run_experiment(
         n_steps=200,
         gamma=0.99,
         max_steps=None,
+        backend=None,
+        inference_server=False,
+        track_pool=None,
+        episodes_per_track=None,
+        world_pool_size=None,
+        multi_car=False,
         ):
     
     if weights is not None and not os.path.isfile(weights):
@@ -41,14 +50,37 @@ def run_experiment(
     # Saving args
     args = deepcopy(locals())
 
+    # Backend of the sub-policies, the variable is inherited by the workers
+    server = None
+    if inference_server:
+        # The workers forward their predictions to a single process
+        server,server_address = start_server(backend=backend if backend is not None else 'numpy')
+    elif backend is not None:
+        os.environ['HRL_POLICY_BACKEND'] = backend
+
+    # Tracks shared by the workers, also through an environment variable
+    # Archive in shared memory removed at the end, unless it was given
+    pool_path = None
+    if track_pool is not None:
+        path = create_track_pool(folder=track_pool)
+        if not is_track_archive(track_pool):
+            pool_path = path
+
     # Get env
     env = getattr(environments, env)
 
     # Generate environments
+    env_kwargs = {}
     if max_steps is not None:
-        env = SubprocVecEnv([lambda : env(max_steps=max_steps) for i in range(env_num)])
+        env_kwargs['max_steps'] = max_steps
+    if episodes_per_track is not None:
+        env_kwargs['episodes_per_track'] = episodes_per_track
+    if world_pool_size is not None:
+        env_kwargs['world_pool_size'] = world_pool_size
+    if multi_car:
+        env = MultiCarEnv(env(**env_kwargs),num_cars=env_num)
     else:
-        env = SubprocVecEnv([lambda : env() for i in range(env_num)])
+        env = SubprocVecEnv([lambda : env(**env_kwargs) for i in range(env_num)])
 
     args['env_config'] = str(env.env_method("get_org_config")[0])
     
@@ -132,6 +164,11 @@ def run_experiment(
         else:
             if not not_save:
                 model.save(experiment_folder+"/weights_final")
+    finally:
+        if server is not None:
+            stop_server(server,server_address)
+        if pool_path is not None:
+            remove_track_pool(pool_path)
 
 class Callback:
     def __init__(self,not_save,logger,train_steps,n,experiment_folder,
@@ -12,6 +12,7 @@ import tensorboard_logger
 
 from hrl.common.arg_extractor import get_load_args
 from hrl.common.utils import create_experiment_folder,remove_experiment
+from hrl.policies.policy import InterruptionScheduler
 
 def load_model(
         experiment=None,
@@ -24,7 +25,11 @@ def load_model(
         tensorboard=False,
         tag=None,
         no_render=False,
-        n_ep=None
+        n_ep=None,
+        backend=None,
+        record_obs=None,
+        interrupt_mode='step',
+        interrupt_k=4,
         ):
 
     if policy != None:
@@ -67,6 +72,9 @@ def load_model(
                 create_experiment_folder(folder=folder,tag=tag,args=args)
         print("***** experiment is",experiment_folder)
 
+    if backend is not None:
+        os.environ['HRL_POLICY_BACKEND'] = backend
+
     # Get env
     if env == "CarRacing_v0":
         from gym.envs.box2d import CarRacing
@@ -81,15 +89,25 @@ def load_model(
     model.set_env(env)
 
     #set_trace()
-    if 'interrupting' in str(type(env.envs[0])): # TODO use type of 
-        env.envs[0].set_interrupting_params(ppo=model)
+    interrupting = 'interrupting' in str(type(env.envs[0])) # TODO use type of 
+    if interrupting:
+        ppo = model
+        if backend == 'graph':
+            # Same graph as the options so both can run in one call
+            from hrl.policies.registry import registry
+            ppo = registry.acquire(weights_loc,'graph')
+        scheduler = InterruptionScheduler(mode=interrupt_mode,k=interrupt_k)
+        env.envs[0].set_interrupting_params(ppo=ppo,scheduler=scheduler)
 
     obs = env.reset()
     done_count = 0
     reward = 0
+    recorded_obs = []
     try:
         for current_step in itertools.count():
             action, _states = model.predict(obs)
+            if record_obs is not None:
+                recorded_obs.append(obs[0])
 
             reward = env.get_attr("reward")[0]
             full_reward = env.get_attr("full_reward")[0]
@@ -120,6 +138,13 @@ def load_model(
         if tensorboard and input("Do you want to DELETE this experiment? (Yes/n) ") == "Yes":
             remove_experiment(experiment_folder, folder, experiment_csv, id)
 
+    if interrupting:
+        print("interruptions:",env.envs[0].interruption_stats())
+
+    if record_obs is not None:
+        np.save(record_obs, np.array(recorded_obs))
+        print("**** Observations saved in",record_obs)
+
 
 if __name__ == '__main__':
     # Run arg parser
@@ -8,6 +8,7 @@ import tqdm
 from PIL import Image
 
 from hrl.envs.env import Base
+from hrl.envs.intersections import IntersectionCache, count_intersections
 from hrl.common.arg_extractor import get_track_generator_args
 
 def worker(connection):
@@ -16,7 +17,8 @@ def worker(connection):
     while True:
         env.reset()
         obs = env.render('rgb_array')
-        connection.send((obs,env.track,env.tracks,env.info))
+        intersections = IntersectionCache(env).precompute()
+        connection.send((obs,env.track,env.tracks,env.info,intersections))
         
 def generate_tracks(n_tracks,n_cpu):
     if not os.path.isdir('tracks'):
@@ -47,12 +49,13 @@ def generate_tracks(n_tracks,n_cpu):
         count = 0
         while True:
             for conn in connections:
-                obs,track,tracks,info = conn.recv()
+                obs,track,tracks,info,intersections = conn.recv()
 
                 entry = {}
                 entry['x'] = any(info['x'])
                 entry['t'] = any(info['t'])
                 entry['obstacles'] = True
+                entry['intersections'] = count_intersections(info)
                 df = df.append(entry,ignore_index=True)
 
                 index = max(df.index)
@@ -63,7 +66,8 @@ def generate_tracks(n_tracks,n_cpu):
                 im.save("tracks/" + str(index) + ".jpeg")
 
                 # save arrays as dic
-                dic = {'track':track,'tracks':tracks,'info':info}
+                dic = {'track':track,'tracks':tracks,'info':info,
+                        'intersections':intersections}
 
                 with open('tracks/' + str(index) + '.pkl', 'wb') as handle:
                         pickle.dump(dic, handle, protocol=pickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,45 @@
+import os
+import pickle
+
+import pandas as pd
+import tqdm
+
+from hrl.envs.env import Base
+from hrl.envs.intersections import IntersectionCache, count_intersections
+from hrl.common.arg_extractor import get_track_intersections_args
+
+
+def add_intersections(folder='tracks',overwrite=False):
+    """
+    Adds to every <idx>.pkl of folder the table of IntersectionCache under
+    the key 'intersections', so the envs do not compute it on reset, and
+    the number of intersections of each track to list.csv
+    """
+    track_list = pd.read_csv(folder + '/list.csv',index_col=0)
+    env = Base(load_tracks_from=None)
+    counts = []
+
+    for idx in tqdm.tqdm(track_list.index):
+        path = os.path.join(folder,str(idx) + '.pkl')
+        with open(path,'rb') as f:
+            dictionary = pickle.load(f)
+        counts.append(count_intersections(dictionary['info']))
+        if 'intersections' in dictionary and not overwrite:
+            continue
+
+        env.track  = dictionary['track']
+        env.tracks = dictionary['tracks']
+        env.info   = dictionary['info']
+        dictionary['intersections'] = IntersectionCache(env).precompute()
+
+        with open(path,'wb') as f:
+            pickle.dump(dictionary,f,protocol=pickle.HIGHEST_PROTOCOL)
+    env.close()
+
+    track_list['intersections'] = counts
+    track_list.to_csv(folder + '/list.csv')
+
+
+if __name__=='__main__':
+    args = get_track_intersections_args()
+    add_intersections(folder=args.folder,overwrite=args.overwrite)
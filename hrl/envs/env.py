@@ -1,9 +1,13 @@
 from copy import copy, deepcopy
 import multiprocessing as mp
+import os
+import pickle
+import warnings
 import sys
 
+from Box2D import b2World, b2Body
 from gym.envs.box2d import CarRacing
-from gym.envs.box2d.car_racing import play, default_reward_callback, original_reward_callback, TILE_NAME, SOFT_NEG_REWARD, HARD_NEG_REWARD, WINDOW_W, WINDOW_H, TRACK_WIDTH
+from gym.envs.box2d.car_racing import play, default_reward_callback, original_reward_callback, TILE_NAME, SOFT_NEG_REWARD, HARD_NEG_REWARD, WINDOW_W, WINDOW_H, TRACK_WIDTH, STATE_W, STATE_H
 from gym import spaces
 from pdb import set_trace
 from pyglet import gl
@@ -30,10 +34,31 @@ from hrl.policies.policy import NWO_interrupting as NWO_interrupting_policy
 from hrl.policies.policy import Recovery as Recovery_policy
 from hrl.policies.policy import Recovery_v2 as Recovery_v2_policy
 from hrl.policies.policy import Recovery_v2_interrupting as Recovery_v2_interrupting_policy
+from hrl.policies.policy import InterruptionScheduler
 from hrl.common.visualiser import PickleWrapper, Plotter, worker
+from hrl.envs.tiles import TileTopology, TileContacts, TileContactListener
+from hrl.envs.intersections import IntersectionCache
+from hrl.envs.spawn import SpawnCatalogue
+from hrl.envs.track_pool import get_track_pool, is_track_archive
+from hrl.envs.track_sampler import get_track_sampler
+from hrl.envs.world_pool import WorldPool
+from hrl.envs.raster import SoftwareRenderer
+from hrl.envs.frame_stack import FrameStack
+from hrl.envs.snapshot import dynamic_bodies, get_bodies_state, set_bodies_state, \
+        get_car_state, set_car_state, copy_value, move_away, update_contacts
+
+
+# Tables of IntersectionCache per (folder,track idx), shared by the envs of
+# the process
+_intersections_tables = {}
+_tracks_without_intersections = set()
 
 
 class Base(CarRacing):
+    # Tracks to sample from load_tracks_from, {feature: weight} (see
+    # TrackSampler), None uses the default of CarRacing
+    track_mix = None
+
     def __init__(self, 
             reward_fn=default_reward_callback,
             max_time_out=2.0,
@@ -48,9 +73,54 @@ class Base(CarRacing):
             num_obstacles=100,
             allow_reverse=False, 
             discretize_actions="hard",
+            track_pool=None,
+            episodes_per_track=1,
+            world_pool_size=0,
+            world_pool_bytes=256*2**20,
+            observation_backend='gl',
+            render_on_demand=True,
+            check_render_on_demand=False,
             *args,
             **kwargs
             ):
+        self._tile_contacts = TileContacts()
+        if observation_backend not in ['gl','numpy']:
+            raise ValueError("observation_backend should be gl or numpy")
+        # gl renders the observations with pyglet, numpy with
+        # SoftwareRenderer which does not need a display
+        self.observation_backend = observation_backend
+        self.software_renderer = SoftwareRenderer(self)
+        self._overlays = None
+        self._intersections_key = None
+        # Preallocated stack of the last frames, self.state is a view of it
+        self.frame_stack = FrameStack(4)
+        # Steps whose frames leave the stack before being read are not
+        # rendered (see advance and pause_render), with check_render_on_demand
+        # every step is rendered again and compared with the state
+        self.render_on_demand = render_on_demand
+        self.check_render_on_demand = check_render_on_demand
+        self._skip_render = 0
+        self._render_paused = False
+        self._skipping_render = False
+        self._rendered_frames = []
+        self._returned_frame = None
+        self._pushed_frame = None
+        if is_track_archive(load_tracks_from):
+            # CarRacing only needs list.csv from the folder
+            self.track_pool = get_track_pool(load_tracks_from)
+            load_tracks_from = self.track_pool.get_list_folder()
+        elif load_tracks_from is not None:
+            # Shared tracks, by default the one in HRL_TRACK_POOL if any,
+            # only if they were packed from load_tracks_from
+            self.track_pool = get_track_pool(track_pool)
+            if self.track_pool is not None \
+                    and not self.track_pool.is_packed_from(load_tracks_from):
+                if track_pool is not None:
+                    raise ValueError("The track pool %s was not packed from %s" \
+                            % (track_pool,load_tracks_from))
+                self.track_pool = None
+        else:
+            self.track_pool = None
         super(Base,self).__init__(
                 allow_reverse=allow_reverse,
                 grayscale=1,
@@ -79,6 +149,17 @@ class Base(CarRacing):
         self._async_visualiser = True
         self.tb_logger = tensorboard_logger
         self.total_steps = 0
+        self._load_tracks_from = load_tracks_from
+        self._track_idx = None
+        self.episodes_per_track = episodes_per_track
+        self._episodes_in_track = 0
+        self._pending_track_idx = None
+        self._keep_track = False
+        self.predictions_mask = None
+        self.world_pool = None
+        if world_pool_size > 0 and load_tracks_from is not None:
+            self.world_pool = WorldPool(world_pool_size,world_pool_bytes)
+        self._install_contact_listener()
     
     def _key_press(self,k,mod):
         # to avoid running a process inside a daemon
@@ -152,15 +233,154 @@ class Base(CarRacing):
         self.obstacle_contacts['count_delay'] = 0
         self.obstacle_contacts['count'] = 0
 
+    @property
+    def topology(self):
+        '''
+        TileTopology of the current track, it is built the first time it
+        is used after a new track is loaded
+        '''
+        topology = getattr(self,'_topology',None)
+        if topology is None or topology.tracks is not self.tracks:
+            topology = TileTopology(self.info,self.tracks)
+            self._topology = topology
+        return topology
+
+    @property
+    def intersections(self):
+        '''
+        IntersectionCache of the current track, the table of each track
+        file is loaded (or computed) once per process and shared by every
+        episode using it
+        '''
+        cache = getattr(self,'_intersections',None)
+        if cache is None or cache.tracks is not self.tracks:
+            cache = IntersectionCache(self,self._get_intersections_table())
+            self._intersections = cache
+        return cache
+
+    @property
+    def spawns(self):
+        '''
+        SpawnCatalogue of the current track
+        '''
+        spawns = getattr(self,'_spawns',None)
+        if spawns is None or spawns.tracks is not self.tracks:
+            spawns = SpawnCatalogue(self)
+            self._spawns = spawns
+        return spawns
+
+    def _get_intersections_table(self):
+        return _intersections_tables.get(self._intersections_key)
+
+    def _read_track(self,idx):
+        '''
+        Returns the dictionary of the track idx (track, tracks, info and
+        intersections if it was precomputed) and where it was read from,
+        the track pool when there is one, otherwise <idx>.pkl
+        '''
+        if self.track_pool is not None and idx in self.track_pool:
+            return self.track_pool.get(idx), self.track_pool.path
+        path = os.path.join(self._load_tracks_from,str(idx) + '.pkl')
+        with open(path,'rb') as f:
+            return pickle.load(f), os.path.realpath(self._load_tracks_from)
+
+    def _load_track_from_file(self,idx):
+        '''
+        Loads the track idx with _read_track, its intersections table is
+        kept for the whole process (see _get_intersections_table)
+        '''
+        self._track_idx = idx
+        dictionary, source = self._read_track(idx)
+        self.track  = dictionary['track']
+        self.tracks = dictionary['tracks']
+        self.info   = dictionary['info']
+
+        self._intersections_key = (source,idx)
+        if self._intersections_key not in _intersections_tables:
+            table = dictionary.get('intersections')
+            if table is None:
+                # Filled while it is used, see IntersectionCache
+                table = {}
+                if source not in _tracks_without_intersections:
+                    _tracks_without_intersections.add(source)
+                    warnings.warn("The tracks of %s have no precomputed intersections, " \
+                            "run hrl/common/track_intersections.py" % source)
+            _intersections_tables[self._intersections_key] = table
+
+    @property
+    def track_sampler(self):
+        return get_track_sampler(self.tracks_df,self._load_tracks_from,
+                pool=self.track_pool)
+
+    def _choice_random_track_from_file(self):
+        if self._pending_track_idx is not None:
+            # Already chosen by _reset_from_world_pool
+            idx, self._pending_track_idx = self._pending_track_idx, None
+        elif self.track_mix is None:
+            idx = super(Base,self)._choice_random_track_from_file()
+        else:
+            idx = self.track_sampler.sample(self.track_mix)
+        self._track_idx = idx
+        return idx
+
+    @property
+    def tile_contacts(self):
+        '''
+        TileContacts of the current track, updated with the contact
+        events, use it instead of scanning the counts of info
+        '''
+        if getattr(self,'_listener_world',None) is not self.world:
+            # The world was recreated, the events since then were lost
+            self._install_contact_listener()
+            self._tile_contacts.dirty = True
+        self._tile_contacts.check(self.info,self.tracks)
+        return self._tile_contacts
+
+    def _install_contact_listener(self):
+        '''
+        Wraps the contact listener of the world so the tiles touched are
+        reported to tile_contacts
+        '''
+        world = getattr(self,'world',None)
+        if world is None or getattr(self,'_listener_world',None) is world:
+            return
+        if not isinstance(self.contactListener_keepref,TileContactListener):
+            self.contactListener_keepref = TileContactListener(
+                    self,self.contactListener_keepref)
+        world.contactListener = self.contactListener_keepref
+        self._listener_world = world
+
+    def _set_predictions(self,ids):
+        '''
+        Stores the prediction set as a boolean mask aligned with info, the
+        mask is reused while the track has the same number of tiles
+        '''
+        n = len(self.info)
+        if self.predictions_mask is None or len(self.predictions_mask) != n:
+            self.predictions_mask = np.zeros(n,dtype=bool)
+        else:
+            self.predictions_mask.fill(False)
+        ids = np.asarray(ids,dtype=np.int64)
+        self.predictions_mask[ids[(ids >= 0) & (ids < n)]] = True
+
+    def _in_predictions(self,ids):
+        '''
+        True if any tile of ids is in the prediction set
+        '''
+        mask = self.predictions_mask
+        if mask is None or len(mask) != len(self.info) or len(ids) == 0:
+            return False
+        return bool(mask[ids].any())
+
+    def _check_spaces(self,spaces,direction):
+        if not (spaces > 0 and direction in [1,0,-1]):
+            raise ValueError("Check the attributes used in \
+                    _is_close_to_intersection")
+
     def _check_if_close_to_intersection(self,direction=1):
-        close = False
-        for tile in np.where(
-                (self.info['count_left'] > 0) \
-                    | (self.info['count_right'] > 0))[0]:
-            if self._is_close_to_intersection(tile,direction=direction):
-                close = True
-                break
-        return close
+        tiles = self.tile_contacts.touched_ids()
+        return bool(np.any(self.topology.is_close_to_intersection(
+                tiles,direction=direction)))
 
     def _is_close_to_intersection(self,tile_id,spaces=8,direction=1):
         '''
@@ -170,46 +390,19 @@ class Base(CarRacing):
         direction = {1,0,-1}, going with the flow or agains it, 0
         means both directions
         '''
-        intersection_tiles = self.get_close_intersections(
-                tile_id=tile_id,spaces=spaces,direction=direction)
-        return len(intersection_tiles) > 0
+        self._check_spaces(spaces,direction)
+        return bool(self.topology.is_close_to_intersection(
+                tile_id,spaces=spaces,direction=direction))
 
     def get_close_tiles(self,tile_id,spaces=8,direction=1):
         '''
         Returns a set of the index of the tiles that are space close in
-        the direction direction of tile_id
+        the direction direction of tile_id, stopping at the first
+        intersection
         '''
-        candidates = set()
-        if spaces > 0 and direction in [1,0,-1]:
-            track_id = self.info[tile_id]['track']
-            track_len = len(self.tracks[track_id])
-            other_track_len  = sum(self.info['track'] < track_id)
-
-            tile_id_rel =  tile_id - other_track_len
-
-            candidates = [] # If tile_id is intersection, this return False
-            stop_0, stop_1 = False, False
-            for i in range(spaces):
-                if direction in [1,0] and not stop_1:
-                    possible_candidate = tile_id_rel + 1 + i
-                    possible_candidate %= track_len
-                    possible_candidate += other_track_len
-                    candidates.append(possible_candidate)
-                    if self.info[possible_candidate]['intersection_id'] != -1:
-                        stop_1 = True
-                if direction in [-1,0] and not stop_0:
-                    possible_candidate = tile_id_rel - 1 - i
-                    possible_candidate %= track_len
-                    possible_candidate += other_track_len
-                    candidates.append(possible_candidate)
-                    if self.info[possible_candidate]['intersection_id'] != -1:
-                        stop_0 = True
-
-            candidates = set(candidates)
-        else:
-            raise ValueError("Check the attributes used in \
-                    _is_close_to_intersection")
-        return candidates
+        self._check_spaces(spaces,direction)
+        return self.topology.close_tiles(
+                tile_id,spaces=spaces,direction=direction)
 
     def get_close_intersections(self,tile_id,spaces=8,direction=1):
         '''
@@ -218,28 +411,38 @@ class Base(CarRacing):
 
         direction in [1,0,-1], forward, both, backward
         '''
-        candidates = self.get_close_tiles(tile_id=tile_id,spaces=spaces,direction=direction)
-        positive_candidates = candidates.intersection(
-                np.where(self.info['intersection_id'] != -1)[0])
-        return positive_candidates
+        self._check_spaces(spaces,direction)
+        return self.topology.close_intersections(
+                tile_id,spaces=spaces,direction=direction)
+
+    def _draw_overlay(self,polygons):
+        '''
+        Draws polygons (vertices in window coordinates, color) with GL or
+        keeps them for the software renderer
+        '''
+        if self._overlays is not None:
+            self._overlays.extend(polygons)
+            return
+        for vertices,color in polygons:
+            gl.glBegin(gl.GL_TRIANGLES if len(vertices) == 3 else gl.GL_QUADS)
+            gl.glColor4f(*color)
+            for x,y in vertices:
+                gl.glVertex3f(x,y,0)
+            gl.glEnd()
 
     def _render_center_arrow(self):
-        # Arrow
-        gl.glBegin(gl.GL_TRIANGLES)
-        gl.glColor4f(0.7,0,0,1)
-        gl.glVertex3f(WINDOW_W//2, WINDOW_H-40,0)
-        gl.glVertex3f(WINDOW_W//2-40,WINDOW_H-40-40,0)
-        gl.glVertex3f(WINDOW_W//2+40,WINDOW_H-40-40,0)
-        gl.glEnd()
-
-        # Body
-        gl.glBegin(gl.GL_QUADS)
-        gl.glColor4f(0.7,0,0,1)
-        gl.glVertex3f(WINDOW_W//2+15,WINDOW_H-80,0)
-        gl.glVertex3f(WINDOW_W//2+15,WINDOW_H-80-50,0)
-        gl.glVertex3f(WINDOW_W//2-15,WINDOW_H-80-50,0)
-        gl.glVertex3f(WINDOW_W//2-15,WINDOW_H-80,0)
-        gl.glEnd()
+        color = (0.7,0,0,1)
+        self._draw_overlay([
+                # Arrow
+                ([(WINDOW_W//2, WINDOW_H-40),
+                  (WINDOW_W//2-40,WINDOW_H-40-40),
+                  (WINDOW_W//2+40,WINDOW_H-40-40)],color),
+                # Body
+                ([(WINDOW_W//2+15,WINDOW_H-80),
+                  (WINDOW_W//2+15,WINDOW_H-80-50),
+                  (WINDOW_W//2-15,WINDOW_H-80-50),
+                  (WINDOW_W//2-15,WINDOW_H-80)],color),
+                ])
 
     def _render_side_arrow(self,lat_dir,long_dir):
         '''
@@ -249,25 +452,382 @@ class Base(CarRacing):
         d = 1 if lat_dir == 'right' else 0
         long_dir = (-1)**d
 
-        # Arrow
-        gl.glBegin(gl.GL_TRIANGLES)
-        gl.glColor4f(0.7,0,0,1)
-        gl.glVertex3f(WINDOW_W*d+long_dir*20, WINDOW_H-80,0)
-        gl.glVertex3f(WINDOW_W*d+long_dir*100,WINDOW_H-80-40,0)
-        gl.glVertex3f(WINDOW_W*d+long_dir*100,WINDOW_H-80+40,0)
-        gl.glEnd()
-
-        # Body
-        gl.glBegin(gl.GL_QUADS)
-        gl.glColor4f(0.7,0,0,1)
-        gl.glVertex3f(WINDOW_W*d+long_dir*100,WINDOW_H-80+15,0)
-        gl.glVertex3f(WINDOW_W*d+long_dir*150,WINDOW_H-80+15,0)
-        gl.glVertex3f(WINDOW_W*d+long_dir*150,WINDOW_H-80-15,0)
-        gl.glVertex3f(WINDOW_W*d+long_dir*100,WINDOW_H-80-15,0)
-        gl.glEnd()
+        color = (0.7,0,0,1)
+        self._draw_overlay([
+                # Arrow
+                ([(WINDOW_W*d+long_dir*20, WINDOW_H-80),
+                  (WINDOW_W*d+long_dir*100,WINDOW_H-80-40),
+                  (WINDOW_W*d+long_dir*100,WINDOW_H-80+40)],color),
+                # Body
+                ([(WINDOW_W*d+long_dir*100,WINDOW_H-80+15),
+                  (WINDOW_W*d+long_dir*150,WINDOW_H-80+15),
+                  (WINDOW_W*d+long_dir*150,WINDOW_H-80-15),
+                  (WINDOW_W*d+long_dir*100,WINDOW_H-80-15)],color),
+                ])
+
+    def render(self,mode='human',*args,**kwargs):
+        if mode != 'state_pixels':
+            return super(Base,self).render(mode,*args,**kwargs)
+        if self._skipping_render:
+            frame = np.zeros((STATE_H,STATE_W,3),dtype=np.uint8)
+        else:
+            frame = self._render_state_pixels(*args,**kwargs)
+        if self.check_render_on_demand:
+            self._returned_frame = np.array(frame)
+        return frame
+
+    def _render_state_pixels(self,*args,**kwargs):
+        if self.observation_backend == 'numpy':
+            return self.software_renderer.render()
+        return super(Base,self).render('state_pixels',*args,**kwargs)
+
+    def _update_state(self,new_frame):
+        '''
+        Same as CarRacing._update_state but self.state is a read only view
+        of frame_stack instead of a new array, it is only valid until the
+        next step. A new self.state (set by CarRacing.reset) empties the
+        stack
+        '''
+        if self.frames_per_state <= 1:
+            return super(Base,self)._update_state(new_frame)
+        if self.state is not self.frame_stack.state:
+            dtype = self.state.dtype if isinstance(self.state,np.ndarray) else None
+            self.frame_stack.n = self.frames_per_state
+            self.frame_stack.reset(dtype)
+            self._rendered_frames = []
+        if self.check_render_on_demand:
+            self._pushed_frame = np.array(new_frame)
+        self.state = self.frame_stack.push(new_frame)
+        return self.state
+
+    def advance(self,steps,action=None):
+        '''
+        Steps steps times with the same action (None by default) and
+        returns the last step. Only the last frames_per_state steps are
+        rendered, the frames of the others leave the stack before anybody
+        reads the state. If the episode ends before, the remaining steps
+        are rendered.
+
+        The steps of the options are not skipped since their policies read
+        every state, neither the ones of the resets whose frames stay in
+        the state, only Change_lane_n2n.reset discards frames
+        '''
+        if self.render_on_demand:
+            self._skip_render = max(steps - self.frames_per_state,0)
+        for _ in range(steps):
+            result = self.step(action)
+            if result[2]:
+                self._skip_render = 0
+        if self.check_render_on_demand:
+            self._check_render_on_demand()
+        return result
+
+    def pause_render(self,paused=True):
+        '''
+        The steps while paused are not rendered, only for steps followed
+        by at least frames_per_state steps before the state is read, e.g.
+        the steps of the reset of the parent class followed by advance
+        '''
+        self._render_paused = paused and self.render_on_demand
+
+    def _record_frames(self):
+        '''
+        With check_render_on_demand, keeps for the last frames_per_state
+        steps a new render of the world after the step, the frame returned
+        by render during the step and the one pushed to frame_stack
+        '''
+        returned, pushed = self._returned_frame, self._pushed_frame
+        self._returned_frame = self._pushed_frame = None
+        if returned is None or pushed is None:
+            return
+        fresh = np.array(self._render_state_pixels())
+        self._rendered_frames.append((fresh,returned,pushed))
+        del self._rendered_frames[:-self.frames_per_state]
+
+    def _check_render_on_demand(self):
+        '''
+        Compares the frames in the state with new renders of the plain
+        render('state_pixels') path, see _record_frames
+        '''
+        for i,(fresh,returned,pushed) in enumerate(reversed(self._rendered_frames)):
+            assert np.array_equal(fresh,returned), \
+                    "A frame that was not rendered is in the state"
+            if self.frames_per_state > 1:
+                assert np.array_equal(self.frame_stack.state[...,i],pushed), \
+                        "The frame %i of the state is not the one of its step" % i
+
+    def reset(self):
+        '''
+        Loads a new track every episodes_per_track episodes, the episodes
+        in between use weak_reset
+        '''
+        self._install_contact_listener()
+        if self._keep_track:
+            # The track is shared with other cars (see MultiCarEnv)
+            obs = self.weak_reset()
+            if obs is False:
+                raise ValueError("The car could not be placed in the current track")
+            return obs
+        if 0 < self._episodes_in_track < self.episodes_per_track:
+            obs = self.weak_reset()
+            if obs is not False:
+                self._episodes_in_track += 1
+                return obs
+        if self.world_pool is not None:
+            obs = self._reset_from_world_pool()
+            if obs is not False:
+                self._episodes_in_track = 1
+                return obs
+        obs = super(Base,self).reset()
+        self._episodes_in_track = 1
+        return obs
+
+    # Attributes of the episode of a car set by this class, each subclass
+    # lists the ones it adds, see episode_attributes
+    EPISODE_ATTRIBUTES = ['car','state','reward','prev_reward','full_reward','t',
+            'last_touch_with_track','tile_visited_count','_steps_in_episode',
+            '_current_nodes','_next_nodes','predictions_mask','info',
+            'obstacle_contacts','_tile_contacts',
+            'frame_stack','_skip_render','_render_paused','_skipping_render',
+            '_rendered_frames','active_policies','stats']
+
+    @classmethod
+    def episode_attributes(cls):
+        '''
+        Attributes of the episode of a car, the EPISODE_ATTRIBUTES of every
+        class in the mro of cls. Each car of MultiCarEnv has its own copy
+        and snapshot saves them
+        '''
+        names = []
+        for klass in reversed(cls.__mro__):
+            for name in vars(klass).get('EPISODE_ATTRIBUTES',[]):
+                if name not in names:
+                    names.append(name)
+        return names
+
+    # Attributes of the env that belong to the world of a track, plus every
+    # list of Box2D bodies (tiles, obstacles)
+    WORLD_ATTRIBUTES = ['world','track','tracks','info','obstacle_contacts','road_poly',
+            '_intersections_key']
+
+    def _get_world_attributes(self):
+        names = [name for name in self.WORLD_ATTRIBUTES if hasattr(self,name)]
+        for name,value in vars(self).items():
+            if isinstance(value,list) and len(value) > 0 \
+                    and isinstance(value[0],b2Body):
+                names.append(name)
+        return names
+
+    def _reset_from_world_pool(self):
+        '''
+        Keeps the world of the current track in the pool, if the next track
+        is in the pool it is used with weak_reset, otherwise a new world is
+        created for CarRacing to build the track and False is returned
+        '''
+        # _choice_random_track_from_file sets _track_idx to the new track
+        previous_idx = self._track_idx
+        idx = self._choice_random_track_from_file()
+
+        if previous_idx is not None:
+            self._store_world(previous_idx)
+
+        entry = self.world_pool.pop(idx)
+        if entry is not None:
+            for name,value in entry.items():
+                setattr(self,name,value)
+            self._listener_world = self.world
+            self._track_idx = idx
+            obs = self.weak_reset()
+            if obs is not False:
+                return obs
+            self._store_world(idx)
+
+        # CarRacing builds the next track in a new world
+        self.world = b2World((0,0),contactListener=self.contactListener_keepref)
+        self._listener_world = self.world
+        self._pending_track_idx = idx
+        return False
+
+    def _store_world(self,key):
+        if self.car is not None:
+            self.car.destroy()
+            self.car = None
+        names = self._get_world_attributes()
+        self.world_pool.put(key,dict((name,getattr(self,name)) for name in names))
+        # So CarRacing does not destroy the bodies of the stored world
+        for name in names:
+            if isinstance(getattr(self,name),list):
+                setattr(self,name,[])
+
+    def world_pool_stats(self):
+        return self.world_pool.stats() if self.world_pool is not None else {}
+
+    # Attributes of episode_attributes rebuilt by restore instead of copied
+    SNAPSHOT_EXCLUDED = ['car','state','_tile_contacts','frame_stack','_rendered_frames']
+
+    # Fields of info and obstacle_contacts changed by the contact events,
+    # restore counts them again instead of copying them
+    CONTACT_COUNTS = {'info': ['count_left','count_right'],
+            'obstacle_contacts': ['count']}
+
+    def _clear_contact_counts(self):
+        for name,fields in self.CONTACT_COUNTS.items():
+            for field in fields:
+                getattr(self,name)[field] = 0
+        for wheel in self.car.wheels:
+            wheel.tiles.clear()
+
+    def _get_contact_counts(self):
+        return dict(((name,field),np.array(getattr(self,name)[field])) \
+                for name,fields in self.CONTACT_COUNTS.items() for field in fields)
+
+    def _get_obstacle_lists(self):
+        names = []
+        for name in self._get_world_attributes():
+            value = getattr(self,name)
+            if name != 'road' and isinstance(value,list) and len(value) > 0 \
+                    and isinstance(value[0],b2Body):
+                names.append(name)
+        return names
+
+    def snapshot(self):
+        '''
+        Returns the state of the current episode: the bodies of the car
+        and the obstacles, the attributes of episode_attributes (info counts,
+        objectives, rewards, ...), the stack of frames and the random
+        generators. It only has arrays and python values so it can be
+        pickled and restored in another env with the same config, see
+        restore
+        '''
+        attributes = dict((name,copy_value(getattr(self,name))) \
+                for name in self.episode_attributes() \
+                if name in self.__dict__ and name not in self.SNAPSHOT_EXCLUDED)
+        return {
+                'track_idx': self._track_idx,
+                'bodies': get_bodies_state(dynamic_bodies(self.world)),
+                'obstacles': dict((name,get_bodies_state(getattr(self,name))) \
+                        for name in self._get_obstacle_lists()),
+                'car': get_car_state(self.car),
+                'attributes': attributes,
+                'state': None if self.state is None else np.array(self.state),
+                'episodes_in_track': self._episodes_in_track,
+                'random': np.random.get_state(),
+                'np_random': copy_value(getattr(self,'np_random',None)),
+                }
+
+    def restore(self,snap):
+        '''
+        Continues the episode of snap (see snapshot), its track is loaded
+        first with reset if it is not the current one, so the state of
+        the subclasses that is not in episode_attributes is the one of a
+        new episode. Returns the state
+        '''
+        if self.car is None or self._track_idx != snap['track_idx']:
+            if snap['track_idx'] is None or self._load_tracks_from is None:
+                raise ValueError("Only snapshots of the current track or of " \
+                        "tracks loaded from files can be restored")
+            self._pending_track_idx = snap['track_idx']
+            self._episodes_in_track = 0
+            self.reset()
+            if self._track_idx != snap['track_idx']:
+                raise ValueError("The track %s of the snapshot could not be loaded" \
+                        % snap['track_idx'])
+
+        # Box2D only reports the contacts that begin or end, so the counts
+        # are not copied but counted again: every contact of the bodies
+        # ends away from the track, the counts are cleared and the contacts
+        # at the positions of snap begin
+        bodies = dynamic_bodies(self.world)
+        move_away(bodies)
+        update_contacts(self.world,bodies)
+        self._clear_contact_counts()
+        for name,state in snap['obstacles'].items():
+            set_bodies_state(getattr(self,name),state)
+        if len(snap['obstacles']) > 0:
+            self.software_renderer.invalidate()
+        set_bodies_state(bodies,snap['bodies'])
+        set_car_state(self.car,snap['car'])
+        update_contacts(self.world,bodies)
+        counts = self._get_contact_counts()
+
+        for name,value in snap['attributes'].items():
+            value = copy_value(value)
+            current = self.__dict__.get(name)
+            if isinstance(current,np.ndarray) and current.shape == value.shape \
+                    and current.dtype == value.dtype:
+                # Keeps the arrays shared with the caches (e.g. info)
+                current[...] = value
+            else:
+                setattr(self,name,value)
+        for (name,field),value in counts.items():
+            getattr(self,name)[field] = value
+        self._tile_contacts.dirty = True
+        self._episodes_in_track = snap['episodes_in_track']
+
+        self.frame_stack.reset()
+        self._rendered_frames = []
+        self.state = None
+        if snap['state'] is not None and self.frames_per_state > 1:
+            frames = snap['state']
+            self.frame_stack.reset(frames.dtype)
+            for k in reversed(range(frames.shape[-1])):
+                self.frame_stack.push(frames[...,k])
+            self.state = self.frame_stack.state
+        elif snap['state'] is not None:
+            self.state = np.array(snap['state'])
+
+        np.random.set_state(snap['random'])
+        if snap['np_random'] is not None:
+            self.np_random = copy_value(snap['np_random'])
+        return self.state
+
+    def weak_reset(self):
+        '''
+        Starts a new episode in the current track keeping the tiles and
+        obstacles, only the state of the episode is cleaned and the car is
+        placed again. Returns False if the car could not be placed
+        '''
+        if self.car is not None:
+            self.car.destroy()
+            self.car = None
+
+        self.reward = 0.0
+        self.full_reward = 0.0
+        self.prev_reward = 0.0
+        self.t = 0.0
+        self.last_touch_with_track = 0.0
+        # Counters of CarRacing.reset, _steps_in_episode is the step limit
+        # of the reward functions
+        self.tile_visited_count = 0
+        self._steps_in_episode = 0
+        self._current_nodes = {}
+        self._next_nodes = []
+        if self.predictions_mask is not None:
+            self.predictions_mask.fill(False)
+        for field in ['count_left','count_right','count_left_delay','count_right_delay']:
+            self.info[field] = 0
+        self.info['visited'] = False
+        self.obstacle_contacts['count'] = 0
+        self.obstacle_contacts['count_delay'] = 0
+        self.obstacle_contacts['visited'] = False
+        self._tile_contacts.dirty = True
+        self.frame_stack.reset()
+        self.state = None
+
+        if self._position_car_on_reset() is False:
+            return False
+        return self.step(None)[0]
 
     def step(self,actions):
-        state,step_reward,done,info = super(Base,self).step(actions)
+        self._skipping_render = self._render_paused or self._skip_render > 0
+        try:
+            state,step_reward,done,info = super(Base,self).step(actions)
+        finally:
+            self._skip_render = max(self._skip_render - 1,0)
+            self._skipping_render = False
+        if self.check_render_on_demand:
+            self._record_frames()
+        self.tile_contacts.end_step()
         self.total_steps += 1
         if self.tb_logger is not None and actions is not None:
             self.tb_logger.log_histogram('episode/actions/', actions, self.total_steps)        
@@ -288,16 +848,13 @@ class Original(Base):
             ):
 
         def sota_reward_fn(env):
-            left = env.info['count_left_delay'] > 0
-            right = env.info['count_right_delay'] > 0
-            visited = env.info['visited'] == True
+            contacts = env.tile_contacts
             
             skipped = 0
-            max_tile_touched = np.where(visited)[0]
-            if len(max_tile_touched) > 0:
-                max_tile_touched = max_tile_touched.max()
-
-                min_tile_touching = np.where((left|right) & (visited==False))[0]
+            max_tile_touched = contacts.max_visited
+            if max_tile_touched >= 0:
+                delayed = contacts.delayed_ids()
+                min_tile_touching = delayed[~env.info['visited'][delayed]]
                 if len(min_tile_touching) > 0:
                     min_tile_touching = min_tile_touching.min()
 
@@ -349,32 +906,74 @@ class High_level_env_extension():
             state, reward, done, info = self.raw_step(None)
         else:
             # execute transformed action
+            self._start_option(action)
             state, reward, done, info = self.actions[action](self,self.state)
+            state, reward, done, info = self._end_option(
+                    action, state, reward, done, info)
 
         return state, reward, done, info
 
+    def _start_option(self,action):
+        # Called before running the option chosen by the high level policy
+        pass
+
+    def _end_option(self,action,state,reward,done,info):
+        # Called with the result of the option chosen by the high level policy
+        return state, reward, done, info
+
+    def warmup(self):
+        """
+        Sub-policies load their weights the first time they are used, this
+        loads the whole hierarchy in advance
+        """
+        for policy in self.actions:
+            policy.warmup()
+
+    def close(self):
+        # Releases the shared models of the sub-policies
+        for policy in self.actions:
+            policy.close()
+        super(High_level_env_extension,self).close()
+
 
 class Interrupting_interface():
-    def set_interrupting_params(self,ppo):
+    EPISODE_ATTRIBUTES = ['option_steps']
+
+    def set_interrupting_params(self,ppo,scheduler=None):
+        '''
+        scheduler is an InterruptionScheduler shared by all the options,
+        by default the top level model is checked after every step
+        '''
+        if scheduler is None:
+            scheduler = InterruptionScheduler()
+        self.scheduler = scheduler
         for nid,pol in enumerate(self.actions):
-            pol.set_interrupting_params(nid=nid,ppo=ppo)
+            pol.set_interrupting_params(nid=nid,ppo=ppo,scheduler=scheduler)
+
+    def interruption_stats(self):
+        return self.scheduler.stats()
 
     def reset(self):
         self.option_steps = 0
+        if getattr(self,'scheduler',None) is not None:
+            self.scheduler.reset_tiles()
         return super(Interrupting_interface,self).reset()
 
     def raw_step(self,action):
         self.option_steps += 1
         return super(Interrupting_interface,self).raw_step(action)
 
-    def step(self,action):
-        #print(self.option_steps)
+    def _start_option(self,action):
         self.option_steps = 0
-        return super(Interrupting_interface,self).step(action)
+        super(Interrupting_interface,self)._start_option(action)
 
 
 # Deprecated
 class Turn_side(Base):
+    EPISODE_ATTRIBUTES = ['goal_id','_flow','_direction']
+
+    track_mix = {'x': 0.5, 't': 0.5}
+
     def __init__(self, 
             id='T', 
             high_level=False, 
@@ -388,16 +987,15 @@ class Turn_side(Base):
             reward = -SOFT_NEG_REWARD
             done = False
 
-            predictions_id = [id for l in env._next_nodes for id in l.keys() ]
-            right_old = env.info['count_right_delay'] > 0
-            left_old  = env.info['count_left_delay']  > 0
-            not_visited = env.info['visited'] == False
-            right = env.info['count_right'] > 0
-            left  = env.info['count_left']  > 0
-            track0 = env.info['track'] == 0
-            track1 = env.info['track'] == 1
+            contacts = env.tile_contacts
+            delayed = contacts.delayed_ids()
+            right_old = env.info['count_right_delay'][delayed] > 0
+            left_old  = env.info['count_left_delay'][delayed]  > 0
+            not_visited = env.info['visited'][delayed] == False
+            track0 = env.info['track'][delayed] == 0
+            track1 = env.info['track'][delayed] == 1
 
-            if env.goal_id in np.where(right_old|left_old)[0]:
+            if env.goal_id in delayed:
                 # If in objective
                 reward += 100#10
                 done = True
@@ -407,8 +1005,7 @@ class Turn_side(Base):
                 reward,done = env.check_unvisited_tiles(reward,done)
                 
                 # if still in the prediction set
-                if not done and len(list( set(predictions_id) & set(\
-                        np.where(not_visited & (right_old|left_old))[0]))) > 0:
+                if not done and env._in_predictions(delayed[not_visited]):
         
                     # To allow changes of lane in intersections without lossing points
                     if (left_old & right_old & track0).sum() > 0 and (left_old & right_old & track1).sum() > 0:
@@ -427,9 +1024,8 @@ class Turn_side(Base):
             reward = np.clip(
                     reward, env.min_step_reward, env.max_step_reward)
 
-            env.info['visited'][left_old | right_old] = True
-            env.info['count_right_delay'] = env.info['count_right']
-            env.info['count_left_delay']  = env.info['count_left']
+            contacts.mark_visited(delayed)
+            contacts.commit_delay()
             
             return reward,full_reward,done
 
@@ -445,38 +1041,29 @@ class Turn_side(Base):
         self.goal_id = None
         self.new = True
         self._reward_fn_side = reward_fn
-        self.tracks_df = self.tracks_df[(self.tracks_df['t']) | (self.tracks_df['x'])]
 
         #raise DeprecationWarning("Use v2")
 
-    def _choice_random_track_from_file(self):
-        if np.random.uniform() >= 0.5:
-            idx = np.random.choice(self.tracks_df[self.tracks_df['x']].index)
-        else:
-            idx = np.random.choice(self.tracks_df[self.tracks_df['t']].index)
-        return idx
-
     def update_contact_with_track(self):
         self.update_contact_with_track_side()
 
     def update_contact_with_track_side(self):
         # Only updating it if still in prediction
 
-        not_visited = self.info['visited'] == False
-        right = self.info['count_right'] > 0
-        left  = self.info['count_left']  > 0
-        predictions_id = [id for l in self._next_nodes for id in l.keys() ]
-
         # Intersection of the prediction and the set that you are currently in
-        if len(list( set(predictions_id) & set(\
-                np.where(right|left)[0]))) > 0:
+        if self._in_predictions(self.tile_contacts.touched_ids()):
             self.last_touch_with_track = self.t
             #super(Turn_side,self).update_contact_with_track()
 
-    def _generate_predictions_side(self,filter):
+    def _generate_predictions_side(self,kinds):
+        '''
+        kinds are the kinds of intersections to use, 'x', 't' or 'xt'
+        '''
         Ok = True
         tiles_before = 8
-        idx = np.random.choice(np.where(filter)[0])
+        idx = self.spawns.sample(self.spawns.side_junctions(kinds))
+        if idx is None:
+            return False
 
         idx_relative = idx - (self.info['track'] < self.info[idx]['track']).sum()
         if self.info[idx]['end']:
@@ -504,48 +1091,18 @@ class Turn_side(Base):
             idx_tmp = idx - idx_relative + idx_tmp
             self._next_nodes.append({idx_tmp: {0:-direction,1:-direction}})
 
-        inter = self.understand_intersection(idx,direction)
+        inter = self.intersections.intersection(idx,direction)
         
-        def get_avg_d_of_segment(idx,direction):
-            """
-            Calculate the distance of a segment (between two intersections) to
-            the center of the map.
-            """
-            # get the segments
-            intersection_id = self.info[idx]['intersection_id']
-            track_id = self.info[idx]['track']
-            intersections_nodes = np.where((self.info['intersection_id'] != -1) & (self.info['track'] == track_id))[0]
-            tmp_pos = np.where(intersections_nodes == idx)[0][0]
-            if direction == 1:
-                end = idx
-                start = intersections_nodes[(tmp_pos-1)%len(intersections_nodes)]
-            else:
-                start = idx
-                end = intersections_nodes[(tmp_pos+1)%len(intersections_nodes)]
-
-            ids = []
-            if start > end:
-                ids = []
-                len_other_tracks = (self.info['track'] < track_id).sum()
-                len_track = len(self.tracks[track_id])
-                start = start-len_other_tracks
-                end   = end-len_other_tracks
-                while start != end:
-                    ids.append(len_other_tracks+start)
-                    start = (start+1)%len_track
-                segment = self.track[ids][:,1,2:]
-            else:
-                ids = list(range(start,end))
-                segment = self.track[ids,1,2:]
-            avg_d = np.mean(np.linalg.norm(segment, axis=1))
-            return avg_d,ids
+        # Distance of a segment (between two intersections) to the center
+        # of the map
+        get_avg_d_of_segment = self.intersections.segment
 
         ######## adding nodes after the intersection
         # get avg distance from the origin
         intersection_id = self.info[idx]['intersection_id']
         current_track = self.info[idx]['track']
-        node_id_main_track = np.where((self.info['intersection_id'] == intersection_id) & (self.info['track'] == 0))[0][0]
-        node_id_second_track = np.where((self.info['intersection_id'] == intersection_id) & (self.info['track'] == 1))[0]
+        node_id_main_track = self.intersections.tiles(intersection_id,0)[0]
+        node_id_second_track = self.intersections.tiles(intersection_id,1)
 
         if len(node_id_second_track) == 0:
             # There is no other point in the second track
@@ -584,6 +1141,7 @@ class Turn_side(Base):
         ###########
 
         self.goal_id = list(self._next_nodes[-1].keys())[0]
+        self._set_predictions([id for l in self._next_nodes for id in l.keys()])
         self.new = True
         return Ok
 
@@ -594,13 +1152,7 @@ class Turn_side(Base):
         This is in order to allow several retries to reset 
         the environment
         """
-        filter = (self.info['x']) | ((self.info['t']))# & (self.info['track'] > 0))
-        # TODO why is a track > 0?
-        # Becase originally I thought having allways Left and Right was good
-        if any(filter) == False:
-            return False
-        else:
-            return self._generate_predictions_side(filter)
+        return self._generate_predictions_side('xt')
 
     def _remove_prediction(self, id,lane,direction):
         ###### Removing current new tile from nexts
@@ -715,18 +1267,22 @@ class Turn_n2n(Turn):
 
 # Deprecated
 class Take_center(Base):
+    EPISODE_ATTRIBUTES = ['predictions_id','goal_id','start_id','track_id','lane_id']
+
     def __init__(self, id='TC', reward_fn=None, max_time_out=1.0,*args, **kwargs):
 
         def reward_fn(env):
             reward = -SOFT_NEG_REWARD
             done = False
 
-            right_old  = env.info['count_right_delay']  > 0
-            left_old  = env.info['count_left_delay']  > 0
-            not_visited = env.info['visited'] == False
-            track = env.info['track'] == env.track_id
+            contacts = env.tile_contacts
+            delayed = contacts.delayed_ids()
+            right_old  = env.info['count_right_delay'][delayed]  > 0
+            left_old  = env.info['count_left_delay'][delayed]  > 0
+            not_visited = env.info['visited'][delayed] == False
+            track = env.info['track'][delayed] == env.track_id
 
-            if env.goal_id in np.where(right_old|left_old)[0]:
+            if env.goal_id in delayed:
                 # If in objective
                 reward += 100#10
                 done = True
@@ -737,8 +1293,7 @@ class Take_center(Base):
             
                 # if still in the same lane and same track 
                 # if still in the prediction set
-                if not done and len(list(set(env.predictions_id) & set(\
-                        np.where(not_visited & (right_old|left_old))[0]))) > 0:
+                if not done and env._in_predictions(delayed[not_visited]):
         
                     # if in different lane than original
                     if env.lane_id == 1 and (left_old & track & not_visited).sum() > 0:
@@ -754,9 +1309,8 @@ class Take_center(Base):
             reward = np.clip(
                     reward, env.min_step_reward, env.max_step_reward)
 
-            env.info['visited'][left_old | right_old] = True
-            env.info['count_right_delay'] = env.info['count_right']
-            env.info['count_left_delay']  = env.info['count_left']
+            contacts.mark_visited(delayed)
+            contacts.commit_delay()
             
             return reward,full_reward,done
 
@@ -774,6 +1328,8 @@ class Take_center(Base):
 
     def reset(self):
         self.predictions_id = []
+        if self.predictions_mask is not None:
+            self.predictions_mask.fill(False)
         while True: 
             obs = super(Take_center,self).reset()
             if obs is not False:
@@ -782,7 +1338,7 @@ class Take_center(Base):
         obs = self.step(None)[0]
         return obs
 
-    def _generate_predictions_center(self,filter):
+    def _generate_predictions_center(self,kinds):
         Ok = True
 
         # Chose start randomly before or after intersection
@@ -790,10 +1346,13 @@ class Take_center(Base):
         tiles_before *= 8
 
         # original point
-        idx_org = np.random.choice(np.where(filter)[0])
+        idx_org = self.spawns.sample(self.spawns.center_junctions(
+                -int(np.sign(tiles_before)),kinds))
+        if idx_org is None:
+            return False
         idx_relative = idx_org - (self.info['track'] < self.info[idx_org]['track']).sum()
 
-        intersection = self.understand_intersection(idx_org,-np.sign(tiles_before))
+        intersection = self.intersections.intersection(idx_org,-np.sign(tiles_before))
         if intersection['straight'] == None: return False
 
         # Get start
@@ -843,15 +1402,13 @@ class Take_center(Base):
         self.lane_id = lane if tiles_before > 0 else 1-lane 
 
         self.predictions_id = predictions_before + predictions_after
+        self._set_predictions(self.predictions_id)
 
         return Ok
 
     def _weak_reset_center(self):
         # Finding 'x' intersection
-        filter = self.info['x'] == True
-        if filter.sum() == 0:
-            return False
-        return self._generate_predictions_center(filter)
+        return self._generate_predictions_center('x')
 
     def update_contact_with_track(self):
         self.update_contact_with_track_center()
@@ -859,13 +1416,8 @@ class Take_center(Base):
     def update_contact_with_track_center(self):
         # Only updating it if still in prediction
 
-        not_visited = self.info['visited'] == False
-        right = self.info['count_right'] > 0
-        left  = self.info['count_left']  > 0
-
         # Intersection of the prediction and the set that you are currently in
-        if len(list( set(self.predictions_id) & set(\
-                np.where(right|left)[0]))) > 0:
+        if self._in_predictions(self.tile_contacts.touched_ids()):
             #super(Take_center,self).update_contact_with_track()
             self.last_touch_with_track = self.t
 
@@ -875,6 +1427,11 @@ class Take_center(Base):
 
 # Deprecated
 class X(Turn,Take_center):
+    EPISODE_ATTRIBUTES = ['is_current_type_side']
+
+    # Only tracks with x, half of them also with t
+    track_mix = {'x': 0.5, 'xt': 0.5}
+
     def __init__(self, 
             left_count=0,
             right_count=0,
@@ -912,8 +1469,6 @@ class X(Turn,Take_center):
         self.stats['center_count'] = center_count
         self.stats['total_tracks_generated'] = total_tracks_generated
 
-        self.tracks_df = self.tracks_df[self.tracks_df['x'] == True]
-
         raise DeprecationWarning("Use v2")
 
     def _set_config(self, **kwargs):
@@ -934,9 +1489,9 @@ class X(Turn,Take_center):
                     self._direction = 'right' if np.random.uniform() >= 0.5 else 'left'
                     self._flow = -1 if self._direction == 'right' else 1
 
-                    ok = self._generate_predictions_side(filter)
+                    ok = self._generate_predictions_side('x')
                 else:
-                    ok = self._generate_predictions_center(filter)
+                    ok = self._generate_predictions_center('x')
 
                 if ok:
                     if self.is_current_type_side:
@@ -973,9 +1528,6 @@ class X(Turn,Take_center):
             action = self.actions['take_center']
         return action
 
-    def weak_reset(self):
-        raise NotImplementedError
-
     def update_contact_with_track(self):
         if self.is_current_type_side:
             self.update_contact_with_track_side()
@@ -1021,8 +1573,6 @@ class X_n2n(X):
         self.stats['center_count'] = center_count
         self.stats['total_tracks_generated'] = total_tracks_generated
 
-        self.tracks_df = self.tracks_df[self.tracks_df['x'] == True]
-
     def step(self,action):
         return self.raw_step(action) # To n2n
 
@@ -1033,6 +1583,8 @@ class Y(Turn):
 
 
 class Keep_lane(Base):
+    EPISODE_ATTRIBUTES = ['keeping_left']
+
     def __init__(self, id='KL', allow_outside=False, reward_fn=None,*args,**kwargs):
         def reward_fn_KL(env):
             # Ignore the obstacles
@@ -1040,11 +1592,12 @@ class Keep_lane(Base):
 
             # if touching other track reward = 0
             in_other_lane = 1
+            delayed = env.tile_contacts.delayed_ids()
             if env.keeping_left:
-                if env.info['count_right_delay'].sum() > 0:
+                if env.info['count_right_delay'][delayed].sum() > 0:
                     in_other_lane=0
             else:
-                if env.info['count_left_delay'].sum() > 0:
+                if env.info['count_left_delay'][delayed].sum() > 0:
                     in_other_lane=0
 
             # if close to an intersection done=True
@@ -1087,10 +1640,9 @@ class Keep_lane(Base):
 
     def _position_car_on_reset(self):
         # Place the agent randomly in a good position
-        while True:
-            tile_id = np.random.choice(list(range(len(self.track))))
-            if not self._is_close_to_intersection(tile_id,8):
-                break
+        tile_id = self.spawns.sample(self.spawns.away_from_intersections(8))
+        if tile_id is None:
+            return False
 
         _,beta,x,y = self._get_position_inside_lane(
                 tile_id,x_pos=self.keeping_left,discrete=True)
@@ -1098,6 +1650,11 @@ class Keep_lane(Base):
 
 
 class NWOO_n2n(Base):
+    EPISODE_ATTRIBUTES = ['_objective','_neg_objectives','_directional_state',
+            '_close_to_intersection_state','_long_dir']
+
+    track_mix = {'x': 1}
+
     def __init__(self, 
             id='NWOO', 
             ignore_obstacles_var=True, 
@@ -1154,7 +1711,7 @@ class NWOO_n2n(Base):
             self._reset_objectives()
 
             # Clean visited tiles
-            self.info['visited'] = False
+            self.tile_contacts.clear_visited()
         return reward,full_reward,done
 
     def _reset_objectives(self):
@@ -1165,12 +1722,17 @@ class NWOO_n2n(Base):
     
     def check_unvisited_tiles(self,reward,done):
         if (self.t % 5) <= 2/60:
-            self.info['visited'] = False
+            self.tile_contacts.clear_visited()
         return reward,done
 
     def reset(self):
-        self._clean_NWOO_n2n_vars()
-        return super(NWOO_n2n,self).reset()
+        # _position_car_on_reset of NWO_n2n fails in tracks without a
+        # valid start, then another track is loaded
+        while True:
+            self._clean_NWOO_n2n_vars()
+            obs = super(NWOO_n2n,self).reset()
+            if obs is not False:
+                return obs
 
     def _clean_NWOO_n2n_vars(self):
         self._directional_state = None
@@ -1204,10 +1766,11 @@ class NWOO_n2n(Base):
                     self._close_to_intersection_state = True
 
                     # Choose positive and negative goals
-                    intersection_tiles = intersection_tiles.intersection(
-                            np.where(self.info['track']==self.info[current_tile]['track'])[0])
+                    track_id = self.info[current_tile]['track']
+                    intersection_tiles = set(tile for tile in intersection_tiles \
+                            if self.info[tile]['track'] == track_id)
                     intersection_tile = intersection_tiles.pop()
-                    intersection_dict = self.understand_intersection(
+                    intersection_dict = self.intersections.intersection(
                             intersection_tile,direction)
 
                     options = self._get_options_for_directional(intersection_dict)
@@ -1218,12 +1781,7 @@ class NWOO_n2n(Base):
                     for directional, val in intersection_dict.items():
                         if val is not None:
                             tmp_id, tmp_flow = val
-
-                            track_id = self.info[tmp_id]['track']
-                            track_len = len(self.tracks[track_id])
-                            comp_track_len = sum(self.info['track'] < track_id)
-                            objective = ((tmp_id - comp_track_len + tmp_flow*8) \
-                                    % track_len) + comp_track_len
+                            objective = int(self.topology.move(tmp_id,tmp_flow*8))
                             if directional == self._directional_state:
                                 self._objective = objective
                             else:
@@ -1249,13 +1807,6 @@ class NWOO_n2n(Base):
             elif self._directional_state == 'right':
                 self._render_side_arrow('right',self._long_dir)
 
-    def _choice_random_track_from_file(self):
-        if np.random.uniform() >= 0.0:#0.3:
-            idx = np.random.choice(self.tracks_df[self.tracks_df['x']].index)
-        else:
-            idx = np.random.choice(self.tracks_df[self.tracks_df['t']].index)
-        return idx
-
     def _position_car_on_reset(self):
         beta,x,y = self.get_position_near_junction('x',13)
         angle_noise = np.random.uniform(-1,1)*np.pi/12
@@ -1276,13 +1827,9 @@ class NWOO(High_level_env_extension,NWOO_n2n):
 
         super(NWOO,self).__init__(id=id,high_level=high_level,*args,**kwargs)
 
-    def step(self,action):
-        if action is not None:
-            self._check_and_set_objectives()
-
-        state, reward, done, info = super(NWOO,self).step(action) 
-
-        return state, reward, done, info
+    def _start_option(self,action):
+        self._check_and_set_objectives()
+        super(NWOO,self)._start_option(action)
     
     def check_univisited_tiles(self,reward,done):
         return reward,done
@@ -1366,10 +1913,9 @@ class NWO_n2n(NWOO_n2n):
         return super(NWO_n2n,self).check_obstacles_touched(obstacle_value=obstacle_value)
 
     def _position_car_on_reset(self):
-        while True:
-            beta,x,y,tile_id = self.get_position_near_obstacle(-8) 
-            if not self._is_close_to_intersection(tile_id,8):
-                break
+        tile_id = self.spawns.sample(self.spawns.before_obstacles(8,spaces=8))
+        if tile_id is None:
+            return False
 
         x_pos = 1 if np.random.uniform() >= 0.5 else 0
         _,beta,x,y = self._get_position_inside_lane(
@@ -1397,6 +1943,10 @@ class NWO(High_level_env_extension,NWO_n2n):
 
 
 class Turn_v2_n2n(NWOO_n2n):
+    # x has priority when there are x in track
+    # so to balance things out, here t has some bias
+    track_mix = {'x': 0.3, 't': 0.7}
+
     def __init__(self,id='T',*args,**kwargs):
         super(Turn_v2_n2n,self).__init__(id=id,*args,**kwargs)
 
@@ -1409,15 +1959,6 @@ class Turn_v2_n2n(NWOO_n2n):
         options = super(Turn_v2_n2n,self)._get_options_for_directional(intersection)
         return options
 
-    def _choice_random_track_from_file(self):
-        # x has priority when there are x in track
-        # so to balance things out, here t has some bias
-        if np.random.uniform() >= 0.7: 
-            idx = np.random.choice(self.tracks_df[self.tracks_df['x']].index)
-        else:
-            idx = np.random.choice(self.tracks_df[self.tracks_df['t']].index)
-        return idx
-
     def _check_if_in_objective(self,reward,full_reward,done):
         current_nodes = list(self._current_nodes.keys())
         done_ = False
@@ -1461,6 +2002,8 @@ class Turn_v2(High_level_env_extension,Turn_v2_n2n):
 
 
 class X_v2_n2n(Turn_v2_n2n):
+    track_mix = {'x': 1}
+
     def __init__(self,id='X',*args,**kwargs):
         super(X_v2_n2n,self).__init__(id=id,*args,**kwargs)
     
@@ -1477,10 +2020,6 @@ class X_v2_n2n(Turn_v2_n2n):
 
         return direction
 
-    def _choice_random_track_from_file(self):
-        idx = np.random.choice(self.tracks_df[self.tracks_df['x']].index)
-        return idx
-
 
 class X_v2(High_level_env_extension,X_v2_n2n):
     def __init__(self,*args,**kwargs):
@@ -1549,16 +2088,21 @@ class Change_lane_n2n(Keep_lane):
         return reward,full_reward,done
 
     def reset(self):
-        obs = super(Change_lane_n2n,self).reset()
+        # The frames of the steps of the reset leave the stack in advance
+        self.pause_render()
+        try:
+            obs = super(Change_lane_n2n,self).reset()
+        finally:
+            self.pause_render(False)
         speed = np.random.uniform(0,150)
         self.set_speed(speed)
 
-        for _ in range(self.frames_per_state):
-            obs = self.step(None)[0]
-        return obs
+        return self.advance(self.frames_per_state)[0]
 
 
 class Change_lane_A(High_level_env_extension,Change_lane_n2n):
+    EPISODE_ATTRIBUTES = ['_steps_taken']
+
     def __init__(self,*args,**kwargs):
         self.actions = []
         self.actions.append(Change_to_left_policy(max_steps=10))
@@ -1574,11 +2118,14 @@ class Change_lane_A(High_level_env_extension,Change_lane_n2n):
         self._steps_taken = 0
         return super(Change_lane_A,self).reset()
 
-    def step(self,action):
-        if action is not None: self._steps_taken += 1
-        state,step_reward,done,info = super(Change_lane_A,self).step(action)
-        if self._steps_taken > 0: done=True
-        return state,step_reward,done,info
+    def _start_option(self,action):
+        self._steps_taken += 1
+        super(Change_lane_A,self)._start_option(action)
+
+    def _end_option(self,action,state,reward,done,info):
+        # Only one option per episode
+        return super(Change_lane_A,self)._end_option(
+                action,state,reward,True,info)
 
 
 class Change_lane_B(High_level_env_extension,Keep_lane):
@@ -1790,6 +2337,8 @@ class Nav_perf_intersections(High_level_env_extension,Nav_perf_intersections_n2n
 
 
 class Nav_perf_obstacles_n2n(Nav_n2n):
+    EPISODE_ATTRIBUTES = ['_set_of_near_obstacles']
+
     def __init__(self,reward_fn=None,*args,**kwargs):
         def reward_fn_Nav_obstacles(env):
             reward = 0
@@ -1863,6 +2412,21 @@ class Nav_contrafactual(Nav):
     def _position_car_on_reset(self):
         self.place_agent(self._get_position_inside_lane(0,0)[1:])
 
+    def contrafactual(self):
+        '''
+        Runs every option from the current state, restoring a snapshot of
+        it before each one, and returns the (state, reward, done, info) of
+        each option. The env is left in the current state
+        '''
+        snap = self.snapshot()
+        results = []
+        for action in range(len(self.actions)):
+            self.restore(snap)
+            state, reward, done, info = self.step(action)
+            results.append((np.array(state),reward,done,info))
+        self.restore(snap)
+        return results
+
     def _get_possible_candidates_for_obstacles(self):
         if self.num_obstacles == 1:
             return [15]
@@ -0,0 +1,55 @@
+import numpy as np
+
+
+class FrameStack():
+    """
+    Ring buffer of the last n frames, the stacked state is a view of the
+    buffer so adding a frame does not copy the stack.
+
+    The buffer has every frame twice (positions i and i+n of the last
+    axis), so the last n frames are always the contiguous slice
+    buffer[...,pos:pos+n], the newest frame first as in CarRacing.
+
+    The state is read only and it is only valid until the next push, the
+    oldest frame of the previous state is overwritten, whoever keeps
+    states between steps (e.g. a rollout buffer) has to copy them.
+
+    n:      number of frames in the state (frames_per_state)
+    dtype:  dtype of the state, by default the one of the frames
+    """
+    def __init__(self,n,dtype=None):
+        self.n = n
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.buffer = None
+        self.state = None
+        self._pos = 0
+
+    def reset(self,dtype=None):
+        """
+        Empties the stack, the next push fills the older frames with zeros
+        as CarRacing does after a reset. The buffer is reused when the
+        frames keep their shape and dtype
+        """
+        self.state = None
+        if dtype is not None:
+            self.dtype = np.dtype(dtype)
+
+    def push(self,frame):
+        """
+        Adds frame and returns the state (view) with the last n frames
+        """
+        if self.state is None:
+            dtype = np.asarray(frame).dtype if self.dtype is None else self.dtype
+            shape = np.shape(frame) + (2*self.n,)
+            if self.buffer is None or self.buffer.shape != shape \
+                    or self.buffer.dtype != dtype:
+                self.buffer = np.zeros(shape,dtype=dtype)
+            else:
+                self.buffer.fill(0)
+            self._pos = 0
+        self._pos = (self._pos - 1) % self.n
+        self.buffer[...,self._pos] = frame
+        self.buffer[...,self._pos+self.n] = frame
+        self.state = self.buffer[...,self._pos:self._pos+self.n]
+        self.state.flags.writeable = False
+        return self.state
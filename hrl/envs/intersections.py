@@ -0,0 +1,115 @@
+import numpy as np
+
+from hrl.envs.tiles import TileTopology
+
+
+def get_key(tile_id,direction):
+    return int(tile_id), int(direction)
+
+
+def count_intersections(info):
+    """
+    Number of intersections of a track, the column intersections of
+    list.csv
+    """
+    ids = info['intersection_id']
+    return len(np.unique(ids[ids != -1]))
+
+
+class IntersectionCache():
+    """
+    Answers of understand_intersection and the average distance to the
+    center of the map of the segments around each intersection, computed
+    once per track.
+
+    The answers are kept in table, a plain dict that can be pickled with the
+    track (see hrl/common/track_intersections.py) and shared by every
+    episode using the same track. Entries missing from the table are
+    computed the first time they are asked.
+
+    table = {
+        'intersections': {(tile_id,direction): {'left':...,'right':...,'straight':...}},
+        'segments':      {(tile_id,direction): (avg_d,ids)},
+        }
+    """
+    def __init__(self,env,table=None):
+        self.env = env
+        self.info = env.info
+        self.tracks = env.tracks
+        if table is None:
+            table = {}
+        table.setdefault('intersections',{})
+        table.setdefault('segments',{})
+        self.table = table
+        self._tiles = None
+
+    @property
+    def topology(self):
+        topology = getattr(self.env,'topology',None)
+        if topology is None or topology.info is not self.info:
+            topology = TileTopology(self.info,self.tracks)
+        return topology
+
+    def intersection(self,tile_id,direction):
+        """
+        Same as env.understand_intersection(tile_id,direction)
+        """
+        key = get_key(tile_id,direction)
+        intersections = self.table['intersections']
+        if key not in intersections:
+            intersections[key] = self.env.understand_intersection(*key)
+        intersection = intersections[key]
+        return dict(intersection) if intersection is not None else None
+
+    def segment(self,tile_id,direction):
+        """
+        Average distance to the origin of the segment between the
+        intersection tile tile_id and the previous intersection (direction
+        1) or the next one (direction -1), returns the distance and the ids
+        of the segment
+        """
+        key = get_key(tile_id,direction)
+        segments = self.table['segments']
+        if key not in segments:
+            segments[key] = self._compute_segment(*key)
+        return segments[key]
+
+    def _compute_segment(self,tile_id,direction):
+        topology = self.topology
+        if direction == 1:
+            start = topology.nearest[-1][tile_id]
+            end = tile_id
+        else:
+            start = tile_id
+            end = topology.nearest[1][tile_id]
+        if start == -1:
+            # The only intersection of the track
+            start = end = tile_id
+
+        length = (end - start) % topology.track_len[tile_id]
+        ids = topology.move(start,np.arange(length)).tolist()
+        segment = self.env.track[ids,1,2:]
+        avg_d = np.mean(np.linalg.norm(segment,axis=1))
+        return avg_d,ids
+
+    def tiles(self,intersection_id,track_id):
+        """
+        Ids of the tiles of intersection_id in track_id, sorted
+        """
+        if self._tiles is None:
+            ids = np.where(self.info['intersection_id'] != -1)[0]
+            self._tiles = {}
+            for i in ids:
+                key = (self.info[i]['intersection_id'],self.info[i]['track'])
+                self._tiles.setdefault(key,[]).append(i)
+        return self._tiles.get((intersection_id,track_id),[])
+
+    def precompute(self):
+        """
+        Fills the table for every intersection tile, returns the table
+        """
+        for tile_id in np.where(self.info['intersection_id'] != -1)[0]:
+            for direction in [1,-1]:
+                self.intersection(tile_id,direction)
+                self.segment(tile_id,direction)
+        return self.table
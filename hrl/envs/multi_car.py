@@ -0,0 +1,289 @@
+import copy
+
+import numpy as np
+from Box2D.b2 import contactListener
+from gym.envs.box2d.car_racing import FPS
+from stable_baselines.common.vec_env import VecEnv
+
+from hrl.envs.frame_stack import FrameStack
+from hrl.envs.tiles import TileContacts
+
+
+class DeferredWorld():
+    """
+    Stands for the Box2D world while the cars are stepped one by one,
+    Step only records its arguments, MultiCarEnv steps the real world once
+    for all the cars
+    """
+    def __init__(self,world):
+        self._world = world
+        self.step_args = (1.0/FPS,6*30,2*30)
+
+    def Step(self,*args):
+        self.step_args = args
+
+    def __getattr__(self,name):
+        return getattr(self._world,name)
+
+
+class CarRouter(contactListener):
+    """
+    Contact listener of the shared world, before passing each event to the
+    listener of the env it swaps in the agent whose car is in the contact,
+    so the tiles and obstacles touched are counted for that car
+    """
+    def __init__(self,multi_env,listener):
+        contactListener.__init__(self)
+        self.multi_env = multi_env
+        self.listener = listener
+
+    def BeginContact(self,contact):
+        self._route(contact,self.listener.BeginContact)
+
+    def EndContact(self,contact):
+        self._route(contact,self.listener.EndContact)
+
+    def _route(self,contact,callback):
+        agent = self.multi_env.owner(contact.fixtureA.body)
+        if agent is None:
+            agent = self.multi_env.owner(contact.fixtureB.body)
+        if agent is None:
+            callback(contact)
+            return
+        self.multi_env.swap_in(agent)
+        try:
+            callback(contact)
+        finally:
+            self.multi_env.swap_out(agent)
+
+
+class MultiCarEnv(VecEnv):
+    """
+    num_cars cars that do not interact with each other driving in the same
+    track and Box2D world, with the interface of a VecEnv. The track, its
+    tiles and obstacles are built once for all the cars and the world is
+    stepped once per step.
+
+    Every car has its own copy of the attributes of the env listed by
+    env.episode_attributes() (car, info counts, _current_nodes, obstacle
+    contacts, state, ...), they are swapped in the env to step, reset or
+    count the contacts of that car, the rest of the env is shared.
+
+    The cars are stepped one by one (reward, state) and then the world,
+    so the state and the rewards of contacts of a step are the ones of the
+    world before its physics step, one frame later than with a single car.
+    Each car only sees itself in its state.
+
+    When a car finishes it is placed again in the same track. A new track
+    is loaded after episodes_per_world episodes, ending the episodes of
+    the others (done with info['truncated']).
+
+    Only envs stepping the car once per step are supported, not the high
+    level ones which run policies inside step.
+
+    env:                Base env hosting the world
+    num_cars:           number of cars
+    episodes_per_world: episodes before changing the track, by default
+                        env.episodes_per_track*num_cars
+    """
+    def __init__(self,env,num_cars=4,episodes_per_world=None):
+        if env.high_level:
+            raise ValueError("MultiCarEnv does not support high level envs")
+        super(MultiCarEnv,self).__init__(num_cars,env.observation_space,env.action_space)
+        self.env = env
+        self._attributes = env.episode_attributes()
+        if episodes_per_world is None:
+            episodes_per_world = env.episodes_per_track*num_cars
+        self.episodes_per_world = episodes_per_world
+        self._agents = [{} for _ in range(num_cars)]
+        self._current = None
+        self._episodes = 0
+        self._actions = None
+        self._router = None
+        self._ready = False
+
+    def _names(self):
+        return [name for name in self._attributes if name in self.env.__dict__]
+
+    def swap_in(self,i):
+        """
+        Sets the attributes of agent i in the env
+        """
+        if self._current is not None and self._current != i:
+            self.swap_out(self._current)
+        self.env.__dict__.update(self._agents[i])
+        self._current = i
+
+    def swap_out(self,i):
+        env_dict = self.env.__dict__
+        self._agents[i] = dict((name,env_dict[name]) for name in self._names())
+        self._current = None
+
+    def owner(self,body):
+        """
+        Index of the agent with body in its car, None if it is not a car
+        """
+        for i,agent in enumerate(self._agents):
+            car = agent.get('car')
+            if car is None:
+                continue
+            bodies = [car.hull] + list(car.wheels)
+            user_data = body.userData
+            if user_data is not None and any(user_data is b.userData for b in bodies):
+                return i
+            if any(body == b for b in bodies):
+                return i
+        return None
+
+    def _new_agent(self,template):
+        agent = {}
+        for name,value in template.items():
+            if isinstance(value,np.ndarray):
+                value = np.array(value)
+            elif isinstance(value,(dict,list,set)):
+                value = copy.deepcopy(value)
+            agent[name] = value
+        agent['car'] = None
+        agent['state'] = None
+        agent['_tile_contacts'] = TileContacts()
+        agent['frame_stack'] = FrameStack(template['frame_stack'].n)
+        agent['_rendered_frames'] = []
+        return agent
+
+    def _ignore_other_cars(self):
+        # Fixtures with the same negative group never collide
+        car = self.env.car
+        for body in [car.hull] + list(car.wheels):
+            for fixture in body.fixtures:
+                filter_data = fixture.filterData
+                filter_data.groupIndex = -1
+                fixture.filterData = filter_data
+
+    def _deferred_world(self):
+        env = self.env
+        world = env.world
+        deferred = DeferredWorld(world)
+        env.world = deferred
+        env._listener_world = deferred
+        return world, deferred
+
+    def _restore_world(self,world):
+        self.env.world = world
+        self.env._listener_world = world
+
+    def _reset_agent(self,i):
+        """
+        Places car i again in the current track
+        """
+        world, _ = self._deferred_world()
+        self.swap_in(i)
+        try:
+            obs = self.env.reset()
+            self._ignore_other_cars()
+        finally:
+            self.swap_out(i)
+            self._restore_world(world)
+        return np.array(obs)
+
+    def _reset_world(self):
+        """
+        Loads a new track and places every car in it
+        """
+        env = self.env
+        for i in range(1,self.num_envs):
+            if self._agents[i].get('car') is not None:
+                self.swap_in(i)
+                env.car.destroy()
+                env.car = None
+                self.swap_out(i)
+
+        self.swap_in(0)
+        env._keep_track = False
+        env._episodes_in_track = 0
+        obs = [np.array(env.reset())]
+        env._keep_track = True
+        self._ignore_other_cars()
+        self._router = CarRouter(self,env.contactListener_keepref)
+        env.world.contactListener = self._router
+        self.swap_out(0)
+
+        for i in range(1,self.num_envs):
+            self._agents[i] = self._new_agent(self._agents[0])
+            obs.append(self._reset_agent(i))
+        self._episodes = 0
+        self._ready = True
+        return np.stack(obs)
+
+    def reset(self):
+        return self._reset_world()
+
+    def step_async(self,actions):
+        self._actions = actions
+
+    def step_wait(self):
+        env = self.env
+        obs, rewards, dones, infos = [], [], [], []
+        world, deferred = self._deferred_world()
+        try:
+            for i,action in enumerate(self._actions):
+                self.swap_in(i)
+                state, reward, done, info = env.step(action)
+                self.swap_out(i)
+                obs.append(np.array(state))
+                rewards.append(reward)
+                dones.append(done)
+                infos.append(dict(info) if isinstance(info,dict) else {})
+        finally:
+            self._restore_world(world)
+        world.Step(*deferred.step_args)
+
+        if any(dones):
+            self._episodes += sum(dones)
+            if self._episodes >= self.episodes_per_world:
+                for i in range(self.num_envs):
+                    if not dones[i]:
+                        dones[i] = True
+                        infos[i]['truncated'] = True
+                for i in range(self.num_envs):
+                    infos[i]['terminal_observation'] = obs[i]
+                obs = list(self._reset_world())
+            else:
+                for i in np.where(dones)[0]:
+                    infos[i]['terminal_observation'] = obs[i]
+                    obs[i] = self._reset_agent(i)
+
+        return np.stack(obs), np.array(rewards,dtype=np.float32), \
+                np.array(dones), infos
+
+    def close(self):
+        self.env.close()
+
+    def _indices(self,indices):
+        if indices is None:
+            return range(self.num_envs)
+        if isinstance(indices,int):
+            return [indices]
+        return indices
+
+    def _call(self,i,function):
+        # Before the first reset there are no cars, the env is used as is
+        if not self._ready:
+            return function()
+        self.swap_in(i)
+        try:
+            return function()
+        finally:
+            self.swap_out(i)
+
+    def get_attr(self,attr_name,indices=None):
+        return [self._call(i,lambda: getattr(self.env,attr_name)) \
+                for i in self._indices(indices)]
+
+    def set_attr(self,attr_name,value,indices=None):
+        for i in self._indices(indices):
+            self._call(i,lambda: setattr(self.env,attr_name,value))
+
+    def env_method(self,method_name,*method_args,**method_kwargs):
+        indices = method_kwargs.pop('indices',None)
+        method = lambda: getattr(self.env,method_name)(*method_args,**method_kwargs)
+        return [self._call(i,method) for i in self._indices(indices)]
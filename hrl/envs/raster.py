@@ -0,0 +1,243 @@
+import math
+
+import numpy as np
+from Box2D import b2Body
+from gym.envs.box2d.car_racing import STATE_W, STATE_H, WINDOW_W, WINDOW_H, \
+        ZOOM, SCALE, PLAYFIELD
+
+BACKGROUND_COLOR = (0.4,0.8,0.4)
+GRASS_COLOR = (0.4,0.9,0.4)
+
+
+def fill_polygons(image,polygons,colors):
+    """
+    Draws the convex polygons in image in order, a pixel is painted when
+    its center is inside the polygon
+
+    image:      float array (h,w,3)
+    polygons:   list of arrays (k,2) in pixels, x to the right and y down
+    colors:     list of rgb colors
+    """
+    h, w = image.shape[:2]
+    for poly,color in zip(polygons,colors):
+        x0 = max(int(np.floor(poly[:,0].min())),0)
+        x1 = min(int(np.ceil(poly[:,0].max())),w)
+        y0 = max(int(np.floor(poly[:,1].min())),0)
+        y1 = min(int(np.ceil(poly[:,1].max())),h)
+        if x0 >= x1 or y0 >= y1:
+            continue
+
+        px = np.arange(x0,x1) + 0.5
+        py = (np.arange(y0,y1) + 0.5)[:,None]
+        nxt = np.roll(poly,-1,axis=0)
+        # Orientation of the polygon, the pixels inside are on the same
+        # side of every edge
+        area = np.sum(poly[:,0]*nxt[:,1] - nxt[:,0]*poly[:,1])
+        sign = 1 if area >= 0 else -1
+        inside = np.ones((y1-y0,x1-x0),dtype=bool)
+        for (ax,ay),(bx,by) in zip(poly,nxt):
+            inside &= sign*((bx-ax)*(py-ay) - (by-ay)*(px-ax)) >= 0
+        image[y0:y1,x0:x1][inside] = color[:3]
+    return image
+
+
+def body_polygons(body,color=None):
+    """
+    Polygons in world coordinates of the fixtures of a Box2D body
+    """
+    if color is None:
+        color = getattr(body,'color',(0.,0.,0.))
+    polygons = []
+    transform = body.transform
+    for fixture in body.fixtures:
+        vertices = getattr(fixture.shape,'vertices',None)
+        if vertices is None:
+            continue
+        polygons.append((np.array([transform*v for v in vertices]),color))
+    return polygons
+
+
+def get_camera(env):
+    """
+    Same camera as CarRacing.render, returns zoom, angle and the position
+    of the car
+    """
+    zoom = 0.1*SCALE*max(1-env.t,0) + ZOOM*SCALE*min(env.t,1)
+    scroll_x, scroll_y = env.car.hull.position
+    angle = -env.car.hull.angle
+    vel = env.car.hull.linearVelocity
+    if np.linalg.norm(vel) > 0.5:
+        angle = math.atan2(vel[0],vel[1])
+    return zoom, angle, scroll_x, scroll_y
+
+
+def world_to_window(points,zoom,angle,scroll_x,scroll_y):
+    """
+    Applies the transformation of the viewer of CarRacing to points (n,2)
+    """
+    c, s = math.cos(angle), math.sin(angle)
+    x = points[...,0] - scroll_x
+    y = points[...,1] - scroll_y
+    wx = zoom*(c*x - s*y) + WINDOW_W/2
+    wy = zoom*(s*x + c*y) + WINDOW_H/4
+    return np.stack([wx,wy],axis=-1)
+
+
+def window_to_state(points):
+    """
+    Window coordinates (y up) to pixels of the state (y down), the whole
+    window is drawn in the state viewport
+    """
+    x = points[...,0] * STATE_W / WINDOW_W
+    y = STATE_H - points[...,1] * STATE_H / WINDOW_H
+    return np.stack([x,y],axis=-1)
+
+
+def state_to_world(zoom,angle,scroll_x,scroll_y):
+    """
+    World coordinates of the center of every pixel of the state, the
+    inverse of window_to_state(world_to_window(...)), shape (STATE_H,STATE_W,2)
+    """
+    sx = np.arange(STATE_W) + 0.5
+    sy = (np.arange(STATE_H) + 0.5)[:,None]
+    wx = sx * WINDOW_W / STATE_W - WINDOW_W/2
+    wy = (STATE_H - sy) * WINDOW_H / STATE_H - WINDOW_H/4
+    c, s = math.cos(angle), math.sin(angle)
+    x = (c*wx + s*wy) / zoom + scroll_x
+    y = (-s*wx + c*wy) / zoom + scroll_y
+    return np.stack(np.broadcast_arrays(x,y),axis=-1)
+
+
+class StaticLayer():
+    """
+    The static polygons (background, road, obstacles) rasterised once in
+    world coordinates, every frame is sampled from it so the cost of a
+    frame does not depend on the number of tiles or obstacles
+
+    resolution: pixels per world unit, by default oversample times the
+                one of the state at the max zoom
+    """
+    def __init__(self,polygons,resolution=None,oversample=2):
+        if resolution is None:
+            resolution = oversample*ZOOM*SCALE*STATE_W/WINDOW_W
+        self.resolution = resolution
+        self.low = np.array([-PLAYFIELD,-PLAYFIELD])
+        size = int(np.ceil(2*PLAYFIELD*resolution))
+
+        image = np.zeros((size,size,3),dtype=np.float32)
+        fill_polygons(image,
+                [(poly - self.low) * resolution for poly,_ in polygons],
+                [color for _,color in polygons])
+        self.image = (np.clip(image,0,1)*255).astype(np.uint8)
+
+    def sample(self,camera):
+        """
+        The frame seen by camera (see get_camera), float (STATE_H,STATE_W,3)
+        """
+        points = (state_to_world(*camera) - self.low) * self.resolution
+        col = np.floor(points[...,0]).astype(np.int64)
+        row = np.floor(points[...,1]).astype(np.int64)
+        size = self.image.shape[0]
+        valid = (col >= 0) & (col < size) & (row >= 0) & (row < size)
+        frame = np.zeros((STATE_H,STATE_W,3),dtype=np.float32)
+        frame[valid] = self.image[row[valid],col[valid]] / 255.0
+        return frame
+
+
+class SoftwareRenderer():
+    """
+    Draws the state (STATE_H,STATE_W,3) of a CarRacing env with NumPy, the
+    same as env.render('state_pixels') but without OpenGL (see
+    hrl/common/check_renderer.py for the comparison with the GL frames)
+
+    Static objects are the polygons of road_poly and the bodies of every
+    list of Box2D bodies of the env but road (obstacles), the car is drawn
+    from its hull and wheels and the overlays (arrows) are the polygons
+    given in window coordinates.
+
+    cache_static:   sample the static polygons from a StaticLayer built
+                    once per track instead of drawing them every frame
+    """
+    def __init__(self,env,cache_static=True):
+        self.env = env
+        self.cache_static = cache_static
+        self._layer = None
+        self._layer_tracks = None
+
+    def invalidate(self):
+        """
+        Rebuilds the static layer the next frame, for static bodies moved
+        in the same track (e.g. Base.restore)
+        """
+        self._layer = None
+
+    @property
+    def static_layer(self):
+        # The static objects only change with a new track
+        if self._layer is None or self._layer_tracks is not self.env.tracks:
+            self._layer = StaticLayer(self.static_polygons())
+            self._layer_tracks = self.env.tracks
+        return self._layer
+
+    def background_polygons(self):
+        polygons = [(np.array([[-PLAYFIELD,+PLAYFIELD],[+PLAYFIELD,+PLAYFIELD],
+                [+PLAYFIELD,-PLAYFIELD],[-PLAYFIELD,-PLAYFIELD]]),BACKGROUND_COLOR)]
+        k = PLAYFIELD/20.0
+        for x in range(-20,20,2):
+            for y in range(-20,20,2):
+                polygons.append((np.array([[k*x+k,k*y],[k*x,k*y],
+                        [k*x,k*y+k],[k*x+k,k*y+k]]),GRASS_COLOR))
+        return polygons
+
+    def static_polygons(self):
+        env = self.env
+        polygons = self.background_polygons()
+        polygons += [(np.asarray(poly,dtype=np.float64),color) \
+                for poly,color in getattr(env,'road_poly',[])]
+        for name,value in vars(env).items():
+            if name == 'road' or not isinstance(value,list) or len(value) == 0 \
+                    or not isinstance(value[0],b2Body):
+                continue
+            for body in value:
+                polygons += body_polygons(body)
+        return polygons
+
+    def car_polygons(self):
+        car = self.env.car
+        polygons = []
+        for body in [car.hull] + list(car.wheels):
+            polygons += body_polygons(body)
+        return polygons
+
+    def overlay_polygons(self):
+        """
+        Polygons in window coordinates drawn by _render_additional_objects
+        """
+        env = self.env
+        env._overlays = []
+        try:
+            env._render_additional_objects()
+            return env._overlays
+        finally:
+            env._overlays = None
+
+    def _draw_world(self,image,polygons,camera):
+        if len(polygons) == 0:
+            return
+        projected = [window_to_state(world_to_window(poly,*camera)) \
+                for poly,_ in polygons]
+        fill_polygons(image,projected,[color for _,color in polygons])
+
+    def render(self):
+        camera = get_camera(self.env)
+        if self.cache_static:
+            image = self.static_layer.sample(camera)
+        else:
+            image = np.zeros((STATE_H,STATE_W,3),dtype=np.float32)
+            self._draw_world(image,self.static_polygons(),camera)
+        self._draw_world(image,self.car_polygons(),camera)
+        overlays = self.overlay_polygons()
+        fill_polygons(image,
+                [window_to_state(np.asarray(poly,dtype=np.float64)) for poly,_ in overlays],
+                [color for _,color in overlays])
+        return (np.clip(image,0,1)*255).astype(np.uint8)
@@ -0,0 +1,93 @@
+import copy
+
+import numpy as np
+from Box2D import b2_dynamicBody
+
+# Per body: x, y, angle, vx, vy, angular velocity, awake
+BODY_FIELDS = 7
+
+# Attributes of the wheels of the car that are not in the Box2D bodies
+WHEEL_ATTRIBUTES = ['gas','brake','steer','phase','omega']
+
+# Far from any track, see move_away
+AWAY = 1e5
+
+
+def dynamic_bodies(world):
+    """
+    Dynamic bodies of world (the car), in the order of the world which is
+    the same for worlds built in the same way
+    """
+    return [body for body in world.bodies if body.type == b2_dynamicBody]
+
+
+def get_bodies_state(bodies):
+    state = np.zeros((len(bodies),BODY_FIELDS))
+    for i,body in enumerate(bodies):
+        state[i,:2] = tuple(body.position)
+        state[i,2] = body.angle
+        state[i,3:5] = tuple(body.linearVelocity)
+        state[i,5] = body.angularVelocity
+        state[i,6] = body.awake
+    return state
+
+
+def set_bodies_state(bodies,state):
+    if len(bodies) != len(state):
+        raise ValueError("The snapshot has %i bodies but the world %i" \
+                % (len(state),len(bodies)))
+    for body,(x,y,angle,vx,vy,w,awake) in zip(bodies,state):
+        body.transform = ((x,y),angle)
+        if body.type == b2_dynamicBody:
+            body.linearVelocity = (vx,vy)
+            body.angularVelocity = w
+            body.awake = bool(awake)
+
+
+def move_away(bodies):
+    """
+    Places bodies far from the track and from each other, so the next
+    update_contacts ends every contact they have
+    """
+    for i,body in enumerate(bodies):
+        body.transform = ((AWAY + 100*i,AWAY),0)
+
+
+def update_contacts(world,bodies):
+    """
+    Updates the contacts of bodies after moving them with transform, which
+    Box2D only does while stepping, the listener of the world gets the
+    contacts that begin and end. Sleeping bodies are woken for it since
+    their contacts are not updated
+    """
+    awake = [body.awake for body in bodies]
+    for body in bodies:
+        body.awake = True
+    world.contactManager.FindNewContacts()
+    world.contactManager.Collide()
+    for body,value in zip(bodies,awake):
+        body.awake = value
+
+
+def get_car_state(car):
+    return {
+            'fuel_spent': car.fuel_spent,
+            'wheels': [dict((name,getattr(w,name)) for name in WHEEL_ATTRIBUTES) \
+                    for w in car.wheels],
+            }
+
+
+def set_car_state(car,state):
+    car.fuel_spent = state['fuel_spent']
+    for wheel,values in zip(car.wheels,state['wheels']):
+        for name,value in values.items():
+            setattr(wheel,name,value)
+        # Only used to draw the skid marks
+        wheel.skid_start = None
+        wheel.skid_particle = None
+
+
+def copy_value(value):
+    if isinstance(value,np.ndarray):
+        return np.array(value)
+    return copy.deepcopy(value)
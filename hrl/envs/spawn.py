@@ -0,0 +1,114 @@
+import numpy as np
+
+from hrl.envs.raster import body_polygons
+
+
+class SpawnCatalogue():
+    """
+    Tiles of the current track where each kind of episode can start, so
+    the envs sample a valid start instead of drawing tiles until one
+    works. The catalogues that only depend on the track are built the
+    first time they are used, the ones of obstacles are computed from the
+    current info because the obstacles change with every reset.
+
+    If a catalogue is empty the track cannot be used for that kind of
+    episode and _position_car_on_reset should return False
+    """
+    def __init__(self,env):
+        self.env = env
+        self.info = env.info
+        self.tracks = env.tracks
+        self._catalogues = {}
+
+    def sample(self,ids):
+        """
+        A random element of ids, None if it is empty
+        """
+        if len(ids) == 0:
+            return None
+        return ids[np.random.randint(len(ids))]
+
+    def away_from_intersections(self,spaces=8,direction=1):
+        """
+        Tiles not close to an intersection (see _is_close_to_intersection)
+        """
+        key = ('away',spaces,direction)
+        if key not in self._catalogues:
+            close = self.env.topology.is_close_to_intersection(
+                    np.arange(len(self.info)),spaces=spaces,direction=direction)
+            self._catalogues[key] = np.where(~close)[0]
+        return self._catalogues[key]
+
+    def before_obstacles(self,tiles_before=8,spaces=8):
+        """
+        Tiles tiles_before tiles before an obstacle which are not close to
+        an intersection, once per obstacle so sample chooses an obstacle
+        uniformly as get_position_near_obstacle did
+        """
+        tiles = self.env.topology.move(self.obstacle_tiles(),-tiles_before)
+        return tiles[np.isin(tiles,self.away_from_intersections(spaces))]
+
+    def obstacle_tiles(self):
+        """
+        The tile of each obstacle, the tile with obstacles whose center is
+        the closest to the center of the obstacle. Without the bodies of
+        the obstacles it is every tile with obstacles once
+        """
+        tiles = np.where(self.info['obstacles'])[0]
+        env = self.env
+        bodies = [body for name in env._get_obstacle_lists() for body in getattr(env,name)]
+        if len(tiles) == 0 or len(bodies) == 0 or len(getattr(env,'road',[])) == 0:
+            return tiles
+        centers = self.tile_centers()[tiles]
+        obstacles = np.array([_center(body) for body in bodies])
+        distances = ((obstacles[:,None,:] - centers[None,:,:])**2).sum(axis=-1)
+        return tiles[distances.argmin(axis=1)]
+
+    def tile_centers(self):
+        """
+        Center of each tile of the road, aligned with info
+        """
+        key = ('centers',)
+        if key not in self._catalogues:
+            centers = np.zeros((len(self.info),2))
+            for body in self.env.road:
+                centers[body.userData.id] = _center(body)
+            self._catalogues[key] = centers
+        return self._catalogues[key]
+
+    def _junctions(self,kinds):
+        mask = np.zeros(len(self.info),dtype=bool)
+        for kind in kinds:
+            mask |= self.info[kind]
+        return mask
+
+    def side_junctions(self,kinds='xt'):
+        """
+        Tiles of x (and t) intersections that have tiles in both tracks,
+        valid for _generate_predictions_side
+        """
+        key = ('side',kinds)
+        if key not in self._catalogues:
+            intersections = self.env.intersections
+            ids = [idx for idx in np.where(self._junctions(kinds))[0] \
+                    if len(intersections.tiles(self.info[idx]['intersection_id'],0)) > 0 \
+                    and len(intersections.tiles(self.info[idx]['intersection_id'],1)) > 0]
+            self._catalogues[key] = np.array(ids,dtype=np.int64)
+        return self._catalogues[key]
+
+    def center_junctions(self,direction,kinds='x'):
+        """
+        Tiles of intersections that can be crossed straight coming from
+        direction, valid for _generate_predictions_center
+        """
+        key = ('center',kinds,direction)
+        if key not in self._catalogues:
+            intersections = self.env.intersections
+            ids = [idx for idx in np.where(self._junctions(kinds))[0] \
+                    if intersections.intersection(idx,direction)['straight'] is not None]
+            self._catalogues[key] = np.array(ids,dtype=np.int64)
+        return self._catalogues[key]
+
+
+def _center(body):
+    return np.concatenate([polygon for polygon,_ in body_polygons(body)]).mean(axis=0)
@@ -0,0 +1,246 @@
+from Box2D.b2 import contactListener
+import numpy as np
+
+
+class TileTopology():
+    """
+    Index of the tiles of the current tracks, built once per track.
+
+    For every tile it keeps the offset and length of its track and the
+    distance (in tiles) and id of the next intersection going with the
+    flow (+1) and against it (-1), so the queries about close tiles and
+    intersections do not need to scan info.
+    """
+    def __init__(self,info,tracks):
+        self.info = info
+        self.tracks = tracks
+
+        n = len(info)
+        track = info['track']
+        self.lengths = np.array([len(t) for t in tracks])
+        counts = np.bincount(track,minlength=len(tracks))
+        self.offsets = np.concatenate([[0],np.cumsum(counts)[:-1]])
+
+        self.track_len = self.lengths[track]
+        self.track_offset = self.offsets[track]
+        self.relative = np.arange(n) - self.track_offset
+        self.is_intersection = info['intersection_id'] != -1
+
+        # A distance bigger than any number of spaces means there is no
+        # intersection in the track
+        no_intersection = np.iinfo(np.int64).max
+        self.dist = {
+                1: np.full(n,no_intersection,dtype=np.int64),
+                -1: np.full(n,no_intersection,dtype=np.int64)}
+        self.nearest = {
+                1: np.full(n,-1),
+                -1: np.full(n,-1)}
+        for track_id,(start,length) in enumerate(zip(self.offsets,self.lengths)):
+            if counts[track_id] == 0:
+                continue
+            ids = np.arange(start,start+counts[track_id])
+            positions = np.where(self.is_intersection[ids])[0]
+            if len(positions) == 0:
+                continue
+            rel = self.relative[ids]
+
+            # Next intersection strictly after the tile
+            j = np.searchsorted(positions,rel,side='right')
+            nxt = np.where(j < len(positions),
+                    positions[np.minimum(j,len(positions)-1)],
+                    positions[0] + length)
+            self.dist[1][ids] = nxt - rel
+            self.nearest[1][ids] = nxt % length + start
+
+            # Previous intersection strictly before the tile
+            j = np.searchsorted(positions,rel,side='left') - 1
+            prv = np.where(j >= 0,
+                    positions[np.maximum(j,0)],
+                    positions[-1] - length)
+            self.dist[-1][ids] = rel - prv
+            self.nearest[-1][ids] = prv % length + start
+
+        self.successor = self.move(np.arange(n),1)
+        self.predecessor = self.move(np.arange(n),-1)
+
+    def move(self,tile_id,steps):
+        """
+        The id of the tile steps tiles away in the same track
+        """
+        return (self.relative[tile_id] + steps) % self.track_len[tile_id] \
+                + self.track_offset[tile_id]
+
+    def _directions(self,direction):
+        if direction == 0:
+            return [1,-1]
+        return [direction]
+
+    def close_tiles(self,tile_id,spaces=8,direction=1):
+        """
+        Same as Base.get_close_tiles, the tiles up to spaces tiles away
+        stopping at the first intersection
+        """
+        candidates = set()
+        for d in self._directions(direction):
+            steps = min(spaces,self.dist[d][tile_id])
+            candidates.update(self.move(tile_id,d*np.arange(1,steps+1)).tolist())
+        return candidates
+
+    def close_intersections(self,tile_id,spaces=8,direction=1):
+        intersections = set()
+        for d in self._directions(direction):
+            if self.dist[d][tile_id] <= spaces:
+                intersections.add(int(self.nearest[d][tile_id]))
+        return intersections
+
+    def is_close_to_intersection(self,tile_id,spaces=8,direction=1):
+        """
+        tile_id can be an array, in that case it returns an array
+        """
+        close = False
+        for d in self._directions(direction):
+            close = close | (self.dist[d][tile_id] <= spaces)
+        return close
+
+
+class TileContacts():
+    """
+    Incremental view of the contacts between the car and the tiles.
+
+    It is updated with the begin/end contact events of each tile (see
+    TileContactListener) instead of scanning info every step. It keeps the
+    tiles currently touched, the touched count per track, the candidates
+    for non zero delayed counts and the max visited tile.
+
+    The delayed counts and visited are also written by the reward callbacks
+    of gym, so both are kept as sets of candidates that are filtered with
+    info when read, every tile that is written has been touched since the
+    last step, so the candidates are the tiles touched since then.
+    """
+    def __init__(self):
+        self.info = None
+        self.tracks = None
+        self.dirty = True
+
+    def check(self,info,tracks):
+        if self.dirty or info is not self.info or tracks is not self.tracks:
+            self.resync(info,tracks)
+
+    def resync(self,info,tracks):
+        """
+        Rebuilds the state scanning info, used when a new track is loaded
+        """
+        self.info = info
+        self.tracks = tracks
+        touched = (info['count_left'] > 0) | (info['count_right'] > 0)
+        delayed = (info['count_left_delay'] > 0) | (info['count_right_delay'] > 0)
+        self.touched = set(np.where(touched)[0].tolist())
+        self.per_track = np.bincount(info['track'][touched],minlength=len(tracks))
+        self._recent = set(self.touched)
+        self._delayed = set(np.where(delayed)[0].tolist())
+        visited = np.where(info['visited'])[0]
+        self._max_visited = visited.max() if len(visited) > 0 else -1
+        self.dirty = False
+
+    def update(self,tile_id):
+        """
+        Called after the counts of tile_id changed
+        """
+        info = self.info
+        touched = info['count_left'][tile_id] > 0 or info['count_right'][tile_id] > 0
+        if touched and tile_id not in self.touched:
+            self.touched.add(tile_id)
+            self.per_track[info['track'][tile_id]] += 1
+        elif not touched and tile_id in self.touched:
+            self.touched.remove(tile_id)
+            self.per_track[info['track'][tile_id]] -= 1
+        self._recent.add(tile_id)
+
+    def end_step(self):
+        self._delayed = set(self.delayed_ids().tolist())
+        self._update_max_visited()
+        self._recent = set(self.touched)
+
+    def touched_ids(self):
+        return np.array(sorted(self.touched),dtype=np.int64)
+
+    def delayed_ids(self):
+        """
+        Ids of the tiles with count_left_delay or count_right_delay > 0
+        """
+        info = self.info
+        ids = np.array(sorted(self._delayed | self._recent),dtype=np.int64)
+        delayed = (info['count_left_delay'][ids] > 0) | (info['count_right_delay'][ids] > 0)
+        return ids[delayed]
+
+    def commit_delay(self):
+        """
+        Same as copying count_left and count_right into their delayed
+        versions for every tile
+        """
+        info = self.info
+        ids = np.array(sorted(self._delayed | self._recent),dtype=np.int64)
+        info['count_left_delay'][ids] = info['count_left'][ids]
+        info['count_right_delay'][ids] = info['count_right'][ids]
+        self._delayed = set(self.touched)
+
+    def mark_visited(self,ids):
+        if len(ids) > 0:
+            self.info['visited'][ids] = True
+            self._max_visited = max(self._max_visited,int(np.max(ids)))
+
+    def clear_visited(self):
+        self.info['visited'] = False
+        self._max_visited = -1
+
+    def _update_max_visited(self):
+        # Tiles can only be visited while touched
+        ids = np.array(list(self._recent),dtype=np.int64)
+        visited = ids[self.info['visited'][ids]]
+        if len(visited) > 0:
+            self._max_visited = max(self._max_visited,int(visited.max()))
+
+    @property
+    def max_visited(self):
+        """
+        The highest id of the visited tiles, -1 if none
+        """
+        self._update_max_visited()
+        if self._max_visited >= 0 and not self.info['visited'][self._max_visited]:
+            # visited was cleared outside of clear_visited
+            visited = np.where(self.info['visited'])[0]
+            self._max_visited = visited.max() if len(visited) > 0 else -1
+        return self._max_visited
+
+
+class TileContactListener(contactListener):
+    """
+    Wraps the contact listener of CarRacing and reports to TileContacts the
+    tiles whose counts were changed by each event
+    """
+    def __init__(self,env,listener):
+        contactListener.__init__(self)
+        self.env = env
+        self.listener = listener
+
+    def BeginContact(self,contact):
+        self.listener.BeginContact(contact)
+        self._update(contact)
+
+    def EndContact(self,contact):
+        self.listener.EndContact(contact)
+        self._update(contact)
+
+    def _update(self,contact):
+        contacts = self.env._tile_contacts
+        for fixture in [contact.fixtureA,contact.fixtureB]:
+            tile = fixture.body.userData
+            if tile is None or not hasattr(tile,'road_friction'):
+                continue
+            tile_id = getattr(tile,'id',None)
+            if tile_id is None or contacts.info is None \
+                    or contacts.info is not self.env.info:
+                # Unknown tile, rebuild from info the next time it is read
+                contacts.dirty = True
+            else:
+                contacts.update(tile_id)
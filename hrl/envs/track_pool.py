@@ -0,0 +1,344 @@
+import atexit
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import struct
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+MAGIC = b'HRLTRACK'
+VERSION = 1
+# Sections are aligned to 64 bytes
+ALIGNMENT = 64
+
+INDEX_DTYPE = [
+        ('idx',np.int64),
+        ('start',np.int64),         # first tile of the track in track and info
+        ('end',np.int64),
+        ('lengths_start',np.int64), # first length of its tracks in lengths
+        ('num_tracks',np.int64),
+        ]
+
+
+def get_fingerprint(folder):
+    """
+    Hash of the name, size and modification time of list.csv and of every
+    track of folder, it changes when the dataset changes
+    """
+    track_list = pd.read_csv(os.path.join(folder,'list.csv'),index_col=0)
+    fingerprint = hashlib.md5()
+    for name in ['list.csv'] + [str(idx) + '.pkl' for idx in track_list.index]:
+        stat = os.stat(os.path.join(folder,name))
+        fingerprint.update(('%s %i %i;' % (name,stat.st_size,stat.st_mtime_ns)).encode('utf-8'))
+    return fingerprint.hexdigest()
+
+
+def get_default_pool_path(folder,fingerprint=None):
+    """
+    A file in shared memory (/dev/shm) when it exists, named after the
+    folder and its fingerprint
+    """
+    if fingerprint is None:
+        fingerprint = get_fingerprint(folder)
+    root = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    name = 'hrl_tracks_%s_%s.tracks' % (
+            os.path.realpath(folder).strip('/').replace('/','_'),fingerprint[:12])
+    return os.path.join(root,name)
+
+
+def is_track_archive(path):
+    if path is None or not os.path.isfile(path):
+        return False
+    with open(path,'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def write_archive(path,arrays,meta):
+    """
+    Writes arrays in a single file: the magic, the length of a json header
+    and the arrays, each one starting at the offset given in the header
+    """
+    sections = {}
+    offset = 0
+    for name,array in arrays.items():
+        sections[name] = {
+                'offset': offset,
+                'dtype': np.lib.format.dtype_to_descr(array.dtype),
+                'shape': list(array.shape),
+                }
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header = dict(meta,version=VERSION,sections=sections)
+    header = json.dumps(header).encode('utf-8')
+    data_start = -(-(len(MAGIC) + 8 + len(header)) // ALIGNMENT) * ALIGNMENT
+
+    with open(path,'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q',len(header)))
+        f.write(header)
+        for name,array in arrays.items():
+            f.seek(data_start + sections[name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(data_start + offset)
+    return path
+
+
+def read_header(path):
+    """
+    Returns the header of the archive and where its arrays start
+    """
+    with open(path,'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a track archive" % path)
+        size, = struct.unpack('<Q',f.read(8))
+        header = json.loads(f.read(size).decode('utf-8'))
+    return header, -(-(len(MAGIC) + 8 + size) // ALIGNMENT) * ALIGNMENT
+
+
+def read_archive(path,mode='c'):
+    """
+    Returns the header and a dict with a np.memmap of each array
+    """
+    header, data_start = read_header(path)
+
+    arrays = {}
+    for name,section in header['sections'].items():
+        dtype = np.lib.format.descr_to_dtype(section['dtype'])
+        shape = tuple(section['shape'])
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.zeros(shape,dtype=dtype)
+            continue
+        arrays[name] = np.memmap(path,dtype=dtype,mode=mode,
+                offset=data_start+section['offset'],shape=shape)
+    return header, arrays
+
+
+def pack_tracks(folder,path,dtype=None):
+    """
+    Writes every track of folder (list.csv and <idx>.pkl) in the archive
+    path, with the sections:
+
+        track:      the arrays track of all the tracks concatenated
+        info:       the arrays info of all the tracks concatenated
+        lengths:    the length of each array in tracks
+        index:      where each track starts and ends (see INDEX_DTYPE)
+        features:   the columns of list.csv (x, t, obstacles, ...) per track
+        intersections, intersections_offsets:
+                    the pickled intersections table of each track (see
+                    hrl/common/track_intersections.py), the one of the
+                    i-th track is between offsets i and i+1, empty if it
+                    has none
+
+    tracks is not saved when it is the same as track split by lengths.
+
+    dtype:  dtype of track, e.g. np.float32, None keeps the original one
+    """
+    track_list = pd.read_csv(os.path.join(folder,'list.csv'),index_col=0)
+    index = np.zeros(len(track_list),dtype=INDEX_DTYPE)
+    track, tracks, info, lengths, tables = [], [], [], [], []
+    shared_tracks = True
+
+    start = 0
+    for i,idx in enumerate(track_list.index):
+        with open(os.path.join(folder,str(idx) + '.pkl'),'rb') as f:
+            dictionary = pickle.load(f)
+        n = len(dictionary['info'])
+        index[i] = (idx,start,start+n,len(lengths),len(dictionary['tracks']))
+        start += n
+
+        track.append(np.asarray(dictionary['track']))
+        table = dictionary.get('intersections')
+        tables.append(b'' if table is None else \
+                pickle.dumps(table,protocol=pickle.HIGHEST_PROTOCOL))
+        info.append(dictionary['info'])
+        tracks.append(np.concatenate(dictionary['tracks']))
+        lengths.extend(len(t) for t in dictionary['tracks'])
+        shared_tracks = shared_tracks and tracks[-1].shape == track[-1].shape \
+                and np.array_equal(tracks[-1],track[-1])
+
+    # Boolean columns (x, t, obstacles) and counts (intersections)
+    columns = [(c,np.int64 if c == 'intersections' else bool) for c in track_list.columns]
+    features = np.zeros(len(track_list),dtype=[('idx',np.int64)] + columns)
+    features['idx'] = track_list.index
+    for c,col_dtype in columns:
+        features[c] = track_list[c].astype(col_dtype)
+
+    track = np.concatenate(track)
+    arrays = {
+            'track': track if dtype is None else track.astype(dtype),
+            'info': np.concatenate(info),
+            'lengths': np.array(lengths,dtype=np.int64),
+            'index': index,
+            'features': features,
+            }
+    if any(len(table) > 0 for table in tables):
+        arrays['intersections'] = np.frombuffer(b''.join(tables),dtype=np.uint8)
+        arrays['intersections_offsets'] = np.concatenate(
+                [[0],np.cumsum([len(table) for table in tables])]).astype(np.int64)
+    if not shared_tracks:
+        tracks = np.concatenate(tracks)
+        arrays['tracks'] = tracks if dtype is None else tracks.astype(dtype)
+
+    meta = {
+            'shared_tracks': shared_tracks,
+            'folder': os.path.realpath(folder),
+            'fingerprint': get_fingerprint(folder),
+            }
+    # Written next to path and renamed, so no process maps a partial file
+    tmp_path = '%s.%i.tmp' % (path,os.getpid())
+    write_archive(tmp_path,arrays,meta)
+    os.replace(tmp_path,path)
+    return path
+
+
+class TrackPool():
+    """
+    Tracks packed with pack_tracks, the arrays are memory mapped so every
+    process using the same archive shares one copy of the dataset
+
+    path:   archive created by pack_tracks
+    """
+    def __init__(self,path):
+        self.path = path
+        # Copy on write, the envs can modify their track without changing
+        # the one of the others
+        self.header, arrays = read_archive(path,mode='c')
+        self.track = arrays['track']
+        self.info = arrays['info']
+        self.lengths = np.array(arrays['lengths'])
+        self.index = np.array(arrays['index'])
+        self.features = np.array(arrays['features'])
+        self.tracks = arrays.get('tracks',self.track)
+        self.intersections = arrays.get('intersections')
+        self.intersections_offsets = np.array(arrays['intersections_offsets']) \
+                if 'intersections_offsets' in arrays else None
+
+        self.tracks_df = pd.DataFrame(
+                dict((c,self.features[c]) for c in self.features.dtype.names[1:]),
+                index=self.features['idx'])
+        self._positions = dict((idx,i) for i,idx in enumerate(self.index['idx']))
+        self._list_folder = None
+        self._packed_from = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self,idx):
+        return idx in self._positions
+
+    def get(self,idx):
+        """
+        Returns the same dictionary as the file <idx>.pkl, track and tracks
+        are views of the pool, info is a copy because the envs write in it
+        """
+        position = self._positions[idx]
+        entry = self.index[position]
+        start, end = entry['start'], entry['end']
+        lengths = self.lengths[entry['lengths_start']:\
+                entry['lengths_start']+entry['num_tracks']]
+        offsets = start + np.concatenate([[0],np.cumsum(lengths)])
+        return {
+                'track': self.track[start:end],
+                'tracks': [self.tracks[a:b] for a,b in zip(offsets[:-1],offsets[1:])],
+                'info': np.array(self.info[start:end]),
+                'intersections': self.get_intersections(position),
+                }
+
+    def get_intersections(self,position):
+        """
+        The intersections table of the track in position, None if it was
+        not packed
+        """
+        if self.intersections_offsets is None:
+            return None
+        a, b = self.intersections_offsets[position:position+2]
+        if a == b:
+            return None
+        return pickle.loads(self.intersections[a:b].tobytes())
+
+    def is_packed_from(self,folder):
+        """
+        True if the archive was packed from the current version of folder
+        """
+        folder = os.path.realpath(folder)
+        if folder not in self._packed_from:
+            try:
+                fingerprint = get_fingerprint(folder)
+            except OSError:
+                fingerprint = None
+            self._packed_from[folder] = folder == self.header.get('folder') \
+                    and fingerprint == self.header.get('fingerprint')
+        return self._packed_from[folder]
+
+    def get_list_folder(self):
+        """
+        A folder with only the list.csv of the archive, for CarRacing which
+        reads it from load_tracks_from. It is removed by close or when the
+        process that created it exits
+        """
+        if self._list_folder is None:
+            self._list_folder = tempfile.mkdtemp(prefix='hrl_tracks_')
+            self._list_folder_pid = os.getpid()
+            self.tracks_df.to_csv(os.path.join(self._list_folder,'list.csv'))
+            atexit.register(self.close)
+        return self._list_folder
+
+    def close(self):
+        # Forked workers share the folder with the process that created it
+        if self._list_folder is not None and self._list_folder_pid == os.getpid():
+            shutil.rmtree(self._list_folder,ignore_errors=True)
+        self._list_folder = None
+
+
+def create_track_pool(folder='tracks',path=None):
+    """
+    Packs folder in shared memory and sets HRL_TRACK_POOL, so every env
+    created afterwards (including the workers of SubprocVecEnv) reads its
+    tracks from the pool instead of the pickle files. An existing archive
+    is only reused if it was packed from the current version of folder.
+    folder can also be an archive, in that case it is used directly.
+    Remove it with remove_track_pool
+    """
+    if is_track_archive(folder):
+        path = folder
+    else:
+        fingerprint = get_fingerprint(folder)
+        if path is None:
+            path = get_default_pool_path(folder,fingerprint)
+        if not is_track_archive(path) \
+                or read_header(path)[0].get('fingerprint') != fingerprint:
+            pack_tracks(folder,path)
+    os.environ['HRL_TRACK_POOL'] = path
+    return path
+
+
+def remove_track_pool(path):
+    """
+    Deletes the archive created by create_track_pool
+    """
+    pool = _pools.pop(path,None)
+    if pool is not None:
+        pool.close()
+    if os.environ.get('HRL_TRACK_POOL') == path:
+        del os.environ['HRL_TRACK_POOL']
+    if os.path.exists(path):
+        os.remove(path)
+
+
+_pools = {}
+
+def get_track_pool(path=None):
+    """
+    The TrackPool of path (by default HRL_TRACK_POOL), one per process,
+    None if there is no pool
+    """
+    if path is None:
+        path = os.environ.get('HRL_TRACK_POOL')
+    if path is None:
+        return None
+    if path not in _pools:
+        _pools[path] = TrackPool(path)
+    return _pools[path]
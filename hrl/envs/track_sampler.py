@@ -0,0 +1,87 @@
+import hashlib
+
+import numpy as np
+
+
+class TrackSampler():
+    """
+    Index of the tracks of the dataset by feature, built once per dataset
+    so choosing a track does not filter tracks_df.
+
+    Every boolean column of list.csv (x, t, obstacles) is a feature, plus
+    xt (x and t) and all. The number of intersections of each track is
+    indexed as intersections_<n>, from the column intersections of
+    list.csv (see hrl/common/track_intersections.py) or else from the
+    TrackPool. More features can be added with add_feature.
+
+    tracks_df:  the DataFrame of list.csv
+    pool:       optional TrackPool of the same dataset
+    """
+    def __init__(self,tracks_df,pool=None):
+        self.index = np.asarray(tracks_df.index)
+        self.ids = {'all': self.index}
+        for column in tracks_df.columns:
+            if tracks_df[column].dtype == bool:
+                self.add_feature(column,tracks_df[column].values)
+        if 'x' in self.ids and 't' in self.ids:
+            self.add_feature('xt',tracks_df['x'].values & tracks_df['t'].values)
+        if 'intersections' in tracks_df.columns:
+            counts = tracks_df['intersections'].values
+            for n in np.unique(counts):
+                self.add_feature('intersections_%i' % n,counts == n)
+        elif pool is not None:
+            self._add_intersections(pool)
+
+    def add_feature(self,name,mask):
+        """
+        mask:   boolean array aligned with tracks_df
+        """
+        self.ids[name] = self.index[np.asarray(mask,dtype=bool)]
+
+    def _add_intersections(self,pool):
+        if 'intersection_id' not in pool.info.dtype.names:
+            return
+        counts = {}
+        for idx in self.index:
+            if idx not in pool:
+                continue
+            entry = pool.index[pool._positions[idx]]
+            intersection_id = pool.info['intersection_id'][entry['start']:entry['end']]
+            n = len(np.unique(intersection_id[intersection_id != -1]))
+            counts.setdefault(n,[]).append(idx)
+        for n,ids in counts.items():
+            self.ids['intersections_%i' % n] = np.array(ids)
+
+    def sample(self,mix):
+        """
+        Returns the idx of a random track
+
+        mix:    dict {feature: weight}, a feature is chosen with probability
+                proportional to its weight and then a track with that
+                feature uniformly, features without tracks are ignored
+        """
+        features = [f for f,w in mix.items() if w > 0 and len(self.ids.get(f,[])) > 0]
+        if len(features) == 0:
+            raise ValueError("There are no tracks with any of the features %s" \
+                    % list(mix.keys()))
+        if len(features) == 1:
+            feature = features[0]
+        else:
+            weights = np.array([mix[f] for f in features],dtype=np.float64)
+            feature = features[np.random.choice(len(features),p=weights/weights.sum())]
+        ids = self.ids[feature]
+        return ids[np.random.randint(len(ids))]
+
+
+_samplers = {}
+
+def get_track_sampler(tracks_df,key,pool=None):
+    """
+    One TrackSampler per dataset (key), selection of its tracks (the rows
+    and columns of tracks_df) and process
+    """
+    ids = np.ascontiguousarray(tracks_df.index.values)
+    key = (key,tuple(tracks_df.columns),hashlib.md5(ids.tobytes()).hexdigest())
+    if key not in _samplers:
+        _samplers[key] = TrackSampler(tracks_df,pool=pool)
+    return _samplers[key]
@@ -0,0 +1,102 @@
+from collections import OrderedDict
+
+import numpy as np
+
+# Rough size of a static body with its fixture and python wrappers
+BODY_BYTES = 2048
+
+
+def estimate_size(entry):
+    """
+    Bytes used by the arrays of entry plus BODY_BYTES per Box2D body
+    """
+    size = 0
+    for value in entry.values():
+        if isinstance(value,np.ndarray):
+            size += value.nbytes
+        elif isinstance(value,list):
+            size += sum(v.nbytes if isinstance(v,np.ndarray) else BODY_BYTES \
+                    for v in value)
+    return size
+
+
+class WorldPool():
+    """
+    LRU cache of the Box2D worlds of the tracks not in use, keyed by track,
+    so loading a track again only places the car (see Base.reset).
+
+    Worlds are taken out of the pool while in use, so the world of the
+    current episode is never evicted.
+
+    max_worlds: max number of worlds kept
+    max_bytes:  max estimated memory (see estimate_size) of the worlds kept
+    """
+    def __init__(self,max_worlds=8,max_bytes=256*2**20):
+        self.max_worlds = max_worlds
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self,key):
+        return key in self._entries
+
+    def put(self,key,entry):
+        """
+        entry:  dict with the attributes of the env that make the world,
+                it must have 'world'
+        """
+        if key in self._entries:
+            self._evict(key)
+        self._entries[key] = entry
+        self._sizes[key] = estimate_size(entry)
+        self.bytes += self._sizes[key]
+        while len(self._entries) > self.max_worlds or \
+                (self.bytes > self.max_bytes and len(self._entries) > 0):
+            self._evict(next(iter(self._entries)))
+            self.evictions += 1
+
+    def pop(self,key):
+        """
+        Takes the world of key out of the pool, None if it is not there
+        """
+        if key not in self._entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry = self._entries.pop(key)
+        self.bytes -= self._sizes.pop(key)
+        return entry
+
+    def _evict(self,key):
+        entry = self._entries.pop(key)
+        self.bytes -= self._sizes.pop(key)
+        destroy_world(entry)
+
+    def clear(self):
+        for key in list(self._entries.keys()):
+            self._evict(key)
+
+    def stats(self):
+        return {
+                'worlds': len(self._entries),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                }
+
+
+def destroy_world(entry):
+    world = entry['world']
+    for value in entry.values():
+        if isinstance(value,list):
+            for body in value:
+                if hasattr(body,'fixtures'):
+                    world.DestroyBody(body)
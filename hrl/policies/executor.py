@@ -0,0 +1,139 @@
+import numpy as np
+
+
+class Frame():
+    """
+    An option running in one env, the equivalent of one Policy.__call__
+    in the stack of calls of the sequential hierarchy
+    """
+    __slots__ = ['policy','n','reward']
+
+    def __init__(self,policy):
+        self.policy = policy
+        self.n = 0
+        self.reward = 0
+
+
+class HierarchyExecutor():
+    """
+    Runs the options chosen for several high level envs at the same time.
+
+    Each env keeps a stack with its active options, at every tick the envs
+    are grouped by the model of the option on top of their stacks and one
+    batched predict is run per model, so N envs inside the same leaf policy
+    cost one forward pass instead of N. The result of every env is the
+    same as calling env.step(action) on it, max_steps and _done of each
+    option are checked per env.
+
+    envs:   list of envs using High_level_env_extension, they should not
+            share policy objects, they can share models (see registry)
+    """
+    def __init__(self,envs):
+        self.envs = envs
+        self.num_envs = len(envs)
+        self.predict_calls = 0
+
+    def reset(self):
+        return np.stack([env.reset() for env in self.envs])
+
+    def close(self):
+        for env in self.envs:
+            env.close()
+
+    def step(self,actions):
+        """
+        Same as the step of a VecEnv, envs that are done are reset
+        """
+        obs, rewards, dones, infos = self.run_options(actions)
+        for i,env in enumerate(self.envs):
+            if dones[i]:
+                obs[i] = env.reset()
+        return np.stack(obs), np.array(rewards), np.array(dones), infos
+
+    def _push(self,i,policy):
+        self.envs[i].add_active_policy(policy.id)
+        self._stacks[i].append(Frame(policy))
+
+    def _predict(self,ids,obs):
+        """
+        Returns the action of the option on top of the stack of each env in
+        ids, one predict per model
+        """
+        actions = {}
+        groups = {}
+        for i in ids:
+            policy = self._stacks[i][-1].policy
+            if policy.fixed_action is not None:
+                actions[i] = policy.fixed_action
+            else:
+                groups.setdefault(id(policy.model),[]).append(i)
+
+        for group in groups.values():
+            model = self._stacks[group[0]][-1].policy.model
+            batch = np.stack([obs[i] for i in group])
+            predicted,_ = model.predict(batch)
+            self.predict_calls += 1
+            for i,a in zip(group,predicted):
+                actions[i] = a
+        return actions
+
+    def run_options(self,actions):
+        """
+        Runs the option actions[i] in self.envs[i] until it finishes,
+        returns lists of obs, rewards, dones and infos
+        """
+        obs = [env.state for env in self.envs]
+        rewards = [0]*self.num_envs
+        dones = [False]*self.num_envs
+        infos = [{} for _ in self.envs]
+        self._stacks = [[] for _ in self.envs]
+
+        active = []
+        for i,(env,action) in enumerate(zip(self.envs,actions)):
+            if action is None:
+                obs[i],rewards[i],dones[i],infos[i] = env.raw_step(None)
+            else:
+                env._start_option(action)
+                self._push(i,env.actions[action])
+                active.append(i)
+
+        while len(active) > 0:
+            # Go down the hierarchy until every env is in a leaf policy
+            pending = [i for i in active if hasattr(self._stacks[i][-1].policy,'actions')]
+            while len(pending) > 0:
+                chosen = self._predict(pending,obs)
+                for i in pending:
+                    self._push(i,self._stacks[i][-1].policy.actions[chosen[i]])
+                pending = [i for i in pending if hasattr(self._stacks[i][-1].policy,'actions')]
+
+            # One primitive step per env
+            chosen = self._predict(active,obs)
+            finished = []
+            for i in active:
+                env = self.envs[i]
+                stack = self._stacks[i]
+                leaf = stack[-1].policy
+                obs[i],reward,dones[i],infos[i] = leaf._raw_step(env,obs[i],chosen[i])
+
+                # Go up while the options are done
+                while len(stack) > 0:
+                    frame = stack[-1]
+                    frame.reward += reward
+                    frame.n += 1
+                    frame.policy.n = frame.n
+                    if not frame.policy._done(env) and not dones[i]:
+                        break
+                    stack.pop()
+                    env.remove_active_policy(frame.policy.id)
+                    reward = frame.reward
+
+                if len(stack) == 0:
+                    rewards[i] = reward
+                    finished.append(i)
+
+            for i in finished:
+                active.remove(i)
+                obs[i],rewards[i],dones[i],infos[i] = self.envs[i]._end_option(
+                        actions[i],obs[i],rewards[i],dones[i],infos[i])
+
+        return obs, rewards, dones, infos
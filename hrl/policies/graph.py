@@ -0,0 +1,137 @@
+import os
+import re
+
+import numpy as np
+import tensorflow as tf
+from stable_baselines import PPO2
+from stable_baselines.common import tf_util
+
+
+class HierarchyGraph():
+    """
+    Holds the networks of every policy of a hierarchy in one graph and one
+    session, each policy lives under its own name scope and is run with
+    predict(policy_id, obs)
+    """
+    def __init__(self):
+        self.graph = tf.Graph()
+        self.sess = tf_util.make_session(graph=self.graph)
+        self._policies = {}
+        self._ids = {}
+
+    def _get_id(self,weights):
+        # e.g. hrl/weights/Turn_left/v1.3_exp111.pkl -> Turn_left_v1_3_exp111
+        folder = os.path.basename(os.path.dirname(weights))
+        name = os.path.splitext(os.path.basename(weights))[0]
+        policy_id = re.sub(r'[^A-Za-z0-9_]','_','_'.join([folder,name]))
+        if policy_id in self._policies:
+            policy_id += '_' + str(len(self._policies))
+        return policy_id
+
+    def add(self,weights):
+        """
+        Imports the policy saved in weights under its own scope and returns
+        its policy_id, weights already in the graph are not loaded twice
+        """
+        path = os.path.realpath(weights)
+        if path in self._ids:
+            return self._ids[path]
+
+        data, params = PPO2._load_from_file(weights)
+        policy_id = self._get_id(weights)
+        with self.graph.as_default():
+            with tf.variable_scope(policy_id):
+                policy = data['policy'](
+                        self.sess,
+                        data['observation_space'],
+                        data['action_space'],
+                        1,1,None,
+                        reuse=False,
+                        **data['policy_kwargs'])
+            variables = tf.trainable_variables(scope=policy_id + '/model')
+
+            if isinstance(params,dict):
+                # Newer versions of stable baselines save the names
+                variables = dict((v.name,v) for v in variables)
+                restores = [variables[policy_id + '/' + name].assign(p) \
+                        for name,p in params.items()]
+            else:
+                restores = [v.assign(p) for v,p in zip(variables,params)]
+            self.sess.run(restores)
+
+        self._policies[policy_id] = (policy,data['observation_space'])
+        self._ids[path] = policy_id
+        return policy_id
+
+    def _feed(self,policy_id,obs,deterministic):
+        policy,observation_space = self._policies[policy_id]
+        obs = np.array(obs)
+        vectorized = obs.shape != observation_space.shape
+        obs = obs.reshape((-1,) + observation_space.shape)
+        fetch = policy.deterministic_action if deterministic else policy.action
+        return fetch,{policy.obs_ph:obs},vectorized
+
+    def predict_many(self,observations,deterministic=False):
+        """
+        Runs several policies in a single session call
+
+        observations:   dict of policy_id -> obs
+        returns:        dict of policy_id -> actions
+        """
+        ids = list(observations.keys())
+        fetches = []
+        feed_dict = {}
+        vectorized = []
+        for policy_id in ids:
+            fetch,feed,vec = self._feed(
+                    policy_id,observations[policy_id],deterministic)
+            fetches.append(fetch)
+            feed_dict.update(feed)
+            vectorized.append(vec)
+
+        actions = self.sess.run(fetches,feed_dict)
+        return dict((policy_id,a if vec else a[0]) \
+                for policy_id,a,vec in zip(ids,actions,vectorized))
+
+    def predict(self,policy_id,obs,deterministic=False):
+        return self.predict_many({policy_id:obs},deterministic)[policy_id]
+
+    def model(self,weights):
+        return GraphModel(self,self.add(weights))
+
+    def close(self):
+        self.sess.close()
+
+
+class GraphModel():
+    """
+    Handle with the same predict interface as PPO2 for a policy living in a
+    HierarchyGraph
+    """
+    def __init__(self,hierarchy,policy_id):
+        self.hierarchy = hierarchy
+        self.policy_id = policy_id
+
+    def predict(self,observation,state=None,mask=None,deterministic=False):
+        return self.hierarchy.predict(
+                self.policy_id,observation,deterministic), None
+
+
+_hierarchy = None
+_models = 0
+
+def load_graph_model(weights):
+    global _hierarchy, _models
+    if _hierarchy is None:
+        _hierarchy = HierarchyGraph()
+    _models += 1
+    return _hierarchy.model(weights)
+
+def close_graph_model(model):
+    # The variables of a single policy cannot be removed from the graph,
+    # the whole graph is freed when no policy uses it anymore
+    global _hierarchy, _models
+    _models -= 1
+    if _models <= 0 and _hierarchy is not None:
+        _hierarchy.close()
+        _hierarchy = None
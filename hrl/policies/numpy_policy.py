@@ -0,0 +1,162 @@
+import base64
+import io
+import json
+import pickle
+import zipfile
+from collections import OrderedDict
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+# Order in which CnnPolicy creates its trainable variables, used for old
+# checkpoints that save the parameters as a list without names
+PARAMETER_NAMES = [
+        'model/c1/w:0', 'model/c1/b:0',
+        'model/c2/w:0', 'model/c2/b:0',
+        'model/c3/w:0', 'model/c3/b:0',
+        'model/fc1/w:0', 'model/fc1/b:0',
+        'model/vf/w:0', 'model/vf/b:0',
+        'model/pi/w:0', 'model/pi/b:0',
+        'model/q/w:0', 'model/q/b:0',
+        ]
+
+# (name, stride) of the convolutions of nature_cnn
+CONV_LAYERS = [('c1',4),('c2',2),('c3',1)]
+
+
+class _Stub():
+    """
+    Stands for any object of stable_baselines or tensorflow found in a
+    checkpoint, those are not needed for inference and importing them
+    would import tensorflow
+    """
+    def __init__(self,*args,**kwargs):
+        pass
+
+    def __call__(self,*args,**kwargs):
+        return self
+
+    def __setstate__(self,state):
+        if isinstance(state,dict):
+            self.__dict__.update(state)
+
+
+class _Unpickler(pickle.Unpickler):
+    def find_class(self,module,name):
+        if module.split('.')[0] in ('stable_baselines','tensorflow'):
+            return _Stub
+        return super(_Unpickler,self).find_class(module,name)
+
+
+def _loads(data):
+    return _Unpickler(io.BytesIO(data)).load()
+
+
+def load_checkpoint(weights):
+    """
+    Reads a checkpoint saved by PPO2.save without importing tensorflow
+
+    returns data,params where params is an OrderedDict of name -> array
+    """
+    if zipfile.is_zipfile(weights):
+        with zipfile.ZipFile(weights,'r') as archive:
+            data = json.loads(archive.read('data').decode())
+            names = json.loads(archive.read('parameter_list').decode())
+            arrays = np.load(io.BytesIO(archive.read('parameters')))
+            params = OrderedDict((name,arrays[name]) for name in names)
+        for key,val in data.items():
+            if isinstance(val,dict) and ':serialized:' in val:
+                data[key] = _loads(base64.b64decode(val[':serialized:']))
+    else:
+        with open(weights,'rb') as f:
+            data, params = _Unpickler(f).load()
+        if not isinstance(params,dict):
+            params = OrderedDict(zip(PARAMETER_NAMES,params))
+    return data, params
+
+
+def get_scaling(observation_space):
+    """
+    Returns the low and range used by CnnPolicy to scale the observations,
+    reduced to scalars when they are equal for every pixel
+    """
+    low = np.asarray(observation_space.low,dtype=np.float32)
+    high = np.asarray(observation_space.high,dtype=np.float32)
+    if np.any(np.isinf(low)) or np.any(np.isinf(high)) or not np.any(high-low != 0):
+        # CnnPolicy does not scale in these cases
+        return np.float32(0), np.float32(1)
+    scale = high - low
+    if np.all(low == low.flat[0]) and np.all(scale == scale.flat[0]):
+        return low.flat[0], scale.flat[0]
+    return low, scale
+
+
+def conv2d(x,w,b,stride):
+    """
+    Valid convolution of x (NHWC) with w (HWIO) as a single matrix product
+    over the strided windows of x
+    """
+    n,h,width,c = x.shape
+    k = w.shape[0]
+    out_h = (h - k) // stride + 1
+    out_w = (width - k) // stride + 1
+    s_n,s_h,s_w,s_c = x.strides
+    windows = as_strided(x,
+            shape=(n,out_h,out_w,k,k,c),
+            strides=(s_n,s_h*stride,s_w*stride,s_h,s_w,s_c),
+            writeable=False)
+    return np.tensordot(windows,w,axes=([3,4,5],[0,1,2])) + b.reshape(-1)
+
+
+class NumpyCnnPolicy():
+    """
+    Forward pass of the CnnPolicy of stable baselines in numpy, it exposes
+    the same predict as PPO2 so it can be used by Policy instead of the
+    full model
+    """
+    def __init__(self,params,observation_shape,low=0,scale=255,seed=None):
+        self.params = params
+        self.observation_shape = tuple(observation_shape)
+        self.low = low
+        self.scale = scale
+        self._rng = np.random.RandomState(seed)
+
+    @classmethod
+    def load(cls,weights):
+        data, params = load_checkpoint(weights)
+        params = OrderedDict((name.replace('model/','').replace(':0',''),
+            np.asarray(p,dtype=np.float32)) for name,p in params.items())
+        low, scale = get_scaling(data['observation_space'])
+        return cls(params,data['observation_space'].shape,low=low,scale=scale)
+
+    def _get(self,name):
+        return self.params[name]
+
+    def _dense(self,x,name):
+        return x.dot(self._get(name + '/w')) + self._get(name + '/b')
+
+    def logits(self,obs):
+        x = (np.asarray(obs,dtype=np.float32) - self.low) / self.scale
+        x = x.astype(np.float32,copy=False)
+        for name,stride in CONV_LAYERS:
+            x = np.maximum(conv2d(
+                x,self._get(name + '/w'),self._get(name + '/b'),stride),0)
+        x = x.reshape(x.shape[0],-1)
+        x = np.maximum(self._dense(x,'fc1'),0)
+        return self._dense(x,'pi')
+
+    def predict(self,observation,state=None,mask=None,deterministic=False):
+        observation = np.asarray(observation)
+        vectorized = observation.shape != self.observation_shape
+        observation = observation.reshape((-1,) + self.observation_shape)
+
+        logits = self.logits(observation)
+        if not deterministic:
+            # Same sampling as CategoricalProbabilityDistribution.sample
+            uniform = self._rng.uniform(size=logits.shape)
+            logits = logits - np.log(-np.log(uniform))
+        actions = np.argmax(logits,axis=-1)
+
+        if not vectorized:
+            actions = actions[0]
+        return actions, None
@@ -1,16 +1,46 @@
 import numpy as np
 from pdb import set_trace
 
-from stable_baselines import PPO2
-from stable_baselines.common.vec_env import DummyVecEnv
+from hrl.policies.registry import registry
 
 class Policy:
-    def __init__(self,weights,id=None,max_steps=40):
-        self.model = PPO2.load(weights)
+    # Action used instead of asking the model, for nodes without weights
+    fixed_action = None
+
+    def __init__(self,weights,id=None,max_steps=40,backend=None):
+        # Models are shared between every node loading the same weights and
+        # are only loaded the first time they are used, see warmup.
+        # backend is one of the backends of the registry, e.g. 'tf' for
+        # PPO2 or 'numpy' to run the network without tensorflow
+        self.weights = weights
+        self.backend = backend if backend is not None else registry.default_backend
+        self._model = None
+        self._next_action = None
         self.max_steps = max_steps
         self.n = 0
         self.id = id
 
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = registry.acquire(self.weights,self.backend)
+        return self._model
+
+    def warmup(self):
+        """
+        Loads the weights now instead of in the first call
+        """
+        self.model
+        return self
+
+    def close(self):
+        if getattr(self,'_model',None) is not None:
+            registry.release(self.weights,self.backend)
+            self._model = None
+
+    def __del__(self):
+        self.close()
+
     def __call__(self,env,state):
         action_rwrd = 0
         done  = False
@@ -19,9 +49,8 @@ class Policy:
 
         obs = state
         env.add_active_policy(self.id)
-        done = self._done(env)
         while self.n == 0 or (not self._done(env) and not done):
-            action, _states = self.model.predict(obs)
+            action = self._predict(obs)
             obs,rewards,done,info = self._raw_step(env,obs,action)
 
             action_rwrd += rewards
@@ -30,10 +59,29 @@ class Policy:
 
         return obs,action_rwrd,done,info
 
+    def _predict(self,obs):
+        # The action can be already computed for this obs, see
+        # InterruptionScheduler
+        if self._next_action is not None:
+            cached_obs, action = self._next_action
+            self._next_action = None
+            if cached_obs is obs:
+                return action
+        action, _states = self.model.predict(obs)
+        return action
+
     def _raw_step(self,env,obs,action):
         obs, rewards, done, info = env.raw_step(action)
         return obs,rewards,done,info
 
+    def _outside(self,env):
+        contacts = getattr(env,'tile_contacts',None)
+        if contacts is not None:
+            return len(contacts.touched) == 0
+        right = env.info['count_right'] > 0
+        left  = env.info['count_left']  > 0
+        return (left|right).sum() == 0
+
     def _done(self,env,allow_outside=False):
         # The conditions are
         # 1. After n steps
@@ -42,13 +90,10 @@ class Policy:
         # 4. If Timeout
         # 3 and 4 are complex, so I am not using them
 
-        right = env.info['count_right'] > 0
-        left  = env.info['count_left']  > 0
-
         done = False
         if self.n >= self.max_steps:
             done = True # 1
-        elif not allow_outside and (left|right).sum() == 0:
+        elif not allow_outside and self._outside(env):
             done = True # 2
 
         return done
@@ -61,6 +106,16 @@ class HighPolicy(Policy):
     def _raw_step(self,env,obs,action):
         return self.actions[action](env,obs)
 
+    def warmup(self):
+        for action in self.actions:
+            action.warmup()
+        return super(HighPolicy,self).warmup()
+
+    def close(self):
+        for action in getattr(self,'actions',[]):
+            action.close()
+        super(HighPolicy,self).close()
+
 
 class Turn_left(Policy):
     def __init__(self,id='TL',max_steps=4,v=None):
@@ -152,8 +207,13 @@ class Turn(HighPolicy):
 
 
 class Y(Policy):
+    # Y has no model, it always runs Turn once
+    fixed_action = 0
+
     def __init__(self,v=None):
         self.id = 'Y'
+        self.max_steps = 0
+        self.n = 0
         if v==1.0:
             """
             this version is a poorly one in an open environment
@@ -165,6 +225,15 @@ class Y(Policy):
             self.turn = Turn(v=1.4)
         else:
             self.turn = Turn()
+        self.actions = [self.turn]
+
+    def warmup(self):
+        self.turn.warmup()
+        return self
+
+    def close(self):
+        if hasattr(self,'turn'):
+            self.turn.close()
 
     def __call__(self,env,state):
         obs = state
@@ -385,17 +454,97 @@ class NWO(HighPolicy):
         super(NWO,self).__init__(w,id=id,max_steps=max_steps)
 
 
+class InterruptionScheduler():
+    """
+    Decides when an interrupting policy asks the top level model if it
+    still wants the current option, and counts how often it interrupts.
+
+    mode:   'step' checks after every step of the option (the original
+            behaviour), 'k' every k steps and 'tile' only when the car
+            touches a different set of tiles
+    fuse:   if the top level model and the model of the option live in
+            the same HierarchyGraph (backend 'graph'), both are run in one
+            call and the action of the option is reused in its next step
+    """
+    MODES = ['step','k','tile']
+
+    def __init__(self,mode='step',k=4,fuse=True):
+        if mode not in self.MODES:
+            raise ValueError("Mode %s not supported, use one of %s" \
+                    % (mode,self.MODES))
+        self.mode = mode
+        self.k = k
+        self.fuse = fuse
+        self.checks = 0
+        self.skipped = 0
+        self.interruptions = {}
+        self._tiles = {}
+
+    def _should_check(self,policy,env):
+        if self.mode == 'k':
+            return policy.n % self.k == 0
+        elif self.mode == 'tile':
+            tiles = frozenset(env._current_nodes.keys())
+            if self._tiles.get(policy.id) == tiles:
+                return False
+            self._tiles[policy.id] = tiles
+        return True
+
+    def _fused(self,ppo,policy):
+        hierarchy = getattr(ppo,'hierarchy',None)
+        return self.fuse and hierarchy is not None and \
+                hierarchy is getattr(policy.model,'hierarchy',None)
+
+    def interrupt(self,policy,env,ppo):
+        """
+        Returns True if the top level model chooses a different option
+        than policy.nid
+        """
+        if not self._should_check(policy,env):
+            self.skipped += 1
+            return False
+
+        obs = env.state
+        self.checks += 1
+        if self._fused(ppo,policy):
+            actions = ppo.hierarchy.predict_many({
+                ppo.policy_id: obs,
+                policy.model.policy_id: obs})
+            action = actions[ppo.policy_id]
+            policy._next_action = (obs,actions[policy.model.policy_id])
+        else:
+            action = ppo.predict(obs)[0]
+
+        if action != policy.nid:
+            self.interruptions[policy.id] = self.interruptions.get(policy.id,0) + 1
+            return True
+        return False
+
+    def reset_tiles(self):
+        self._tiles = {}
+
+    def stats(self):
+        interruptions = sum(self.interruptions.values())
+        return {
+            'checks': self.checks,
+            'skipped': self.skipped,
+            'interruptions': interruptions,
+            'interruption_rate': interruptions / max(self.checks,1),
+            'interruptions_per_option': dict(self.interruptions),
+            }
+
+
 class Interrupting_interface():
-    def set_interrupting_params(self,nid,ppo):
+    def set_interrupting_params(self,nid,ppo,scheduler=None):
         self.nid = nid
         self.ppo = ppo
         self.max_steps = 1000
+        self.scheduler = scheduler if scheduler is not None else InterruptionScheduler()
 
     def _done(self,env,allow_outside=False):
         done = super(Interrupting_interface,self)._done(env,allow_outside=allow_outside)
         if not done:
-            if self.ppo.predict(env.state)[0] != self.nid:
-                done = True
+            done = self.scheduler.interrupt(self,env,self.ppo)
         return done
 
 
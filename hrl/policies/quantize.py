@@ -0,0 +1,120 @@
+import os
+
+import numpy as np
+
+from hrl.policies.numpy_policy import NumpyCnnPolicy
+
+PRECISIONS = ['float16','int8']
+
+
+def get_quantized_path(weights,precision):
+    """
+    hrl/weights/X/v1.1.pkl -> hrl/weights/X/v1.1_int8.npz
+    """
+    return os.path.splitext(weights)[0] + '_' + precision + '.npz'
+
+
+def quantize_parameters(params,precision):
+    """
+    Returns a dict with the parameters in the given precision, int8 uses a
+    symmetric scale per output channel stored as name + '/scale'. Biases
+    are small and are kept in float32.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError("Precision %s not supported, use one of %s" \
+                % (precision,PRECISIONS))
+
+    quantized = {}
+    for name,p in params.items():
+        p = np.asarray(p,dtype=np.float32)
+        if not name.endswith('/w'):
+            quantized[name] = p
+        elif precision == 'float16':
+            quantized[name] = p.astype(np.float16)
+        else:
+            axes = tuple(range(p.ndim-1))
+            scale = np.abs(p).max(axis=axes) / 127
+            scale[scale == 0] = 1
+            quantized[name] = np.round(p / scale).astype(np.int8)
+            quantized[name + '/scale'] = scale.astype(np.float32)
+    return quantized
+
+
+class QuantizedCnnPolicy(NumpyCnnPolicy):
+    """
+    NumpyCnnPolicy whose weights are kept in float16 or int8. The dense
+    layers multiply by blocks of columns so only BLOCK columns are in
+    float32 at a time, the scale of int8 is applied to the output. The
+    convolutions are small and are converted back to float32 while used
+    """
+    BLOCK = 128
+
+    def _get(self,name):
+        p = self.params[name]
+        if p.dtype == np.int8:
+            return p.astype(np.float32) * self.params[name + '/scale']
+        return p.astype(np.float32,copy=False)
+
+    def _dense(self,x,name):
+        w = self.params[name + '/w']
+        out = np.empty((x.shape[0],w.shape[1]),dtype=np.float32)
+        for j in range(0,w.shape[1],self.BLOCK):
+            out[:,j:j+self.BLOCK] = x.dot(w[:,j:j+self.BLOCK])
+        if w.dtype == np.int8:
+            out *= self.params[name + '/w/scale']
+        return out + self.params[name + '/b']
+
+    @classmethod
+    def load(cls,weights,precision='float16'):
+        """
+        Loads the converted weights if save_quantized was run, otherwise
+        the checkpoint is converted in memory
+        """
+        path = get_quantized_path(weights,precision)
+        if os.path.isfile(path):
+            arrays = np.load(path)
+            params = dict((name,arrays[name]) for name in arrays.files \
+                    if not name.startswith('obs/'))
+            return cls(params,
+                    tuple(arrays['obs/shape']),
+                    low=arrays['obs/low'],
+                    scale=arrays['obs/scale'])
+
+        model = NumpyCnnPolicy.load(weights)
+        return cls(quantize_parameters(model.params,precision),
+                model.observation_shape,
+                low=model.low,
+                scale=model.scale)
+
+
+def save_quantized(weights,precision):
+    model = NumpyCnnPolicy.load(weights)
+    params = quantize_parameters(model.params,precision)
+    params['obs/shape'] = np.array(model.observation_shape)
+    params['obs/low'] = np.asarray(model.low)
+    params['obs/scale'] = np.asarray(model.scale)
+
+    path = get_quantized_path(weights,precision)
+    np.savez(path,**params)
+    return path
+
+
+def check_agreement(weights,precision,observations,batch_size=256):
+    """
+    Replays recorded observations through the float32 and the reduced
+    precision networks and returns the fraction of observations where
+    both choose the same action (argmax of the logits)
+
+    observations:   array of shape (n,) + observation shape, e.g. saved
+                    with run_model --record_obs
+    """
+    reference = NumpyCnnPolicy.load(weights)
+    quantized = QuantizedCnnPolicy.load(weights,precision)
+
+    agree = 0
+    for i in range(0,len(observations),batch_size):
+        obs = observations[i:i+batch_size]
+        a = reference.predict(obs,deterministic=True)[0]
+        b = quantized.predict(obs,deterministic=True)[0]
+        agree += (a == b).sum()
+    return agree / len(observations)
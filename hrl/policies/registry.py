@@ -0,0 +1,127 @@
+import os
+
+
+def _load_ppo2(weights):
+    from stable_baselines import PPO2
+    return PPO2.load(weights)
+
+
+def _close_ppo2(model):
+    sess = getattr(model, 'sess', None)
+    if sess is not None:
+        sess.close()
+
+
+def _load_graph(weights):
+    from hrl.policies.graph import load_graph_model
+    return load_graph_model(weights)
+
+
+def _close_graph(model):
+    from hrl.policies.graph import close_graph_model
+    close_graph_model(model)
+
+
+def _load_numpy(weights):
+    from hrl.policies.numpy_policy import NumpyCnnPolicy
+    return NumpyCnnPolicy.load(weights)
+
+
+def _load_quantized(precision):
+    def loader(weights):
+        from hrl.policies.quantize import QuantizedCnnPolicy
+        return QuantizedCnnPolicy.load(weights,precision)
+    return loader
+
+
+def _load_mapped(weights):
+    from hrl.policies.weight_store import load_mapped
+    return load_mapped(weights)
+
+
+def _load_remote(weights):
+    from hrl.policies.server import RemoteModel
+    return RemoteModel(weights)
+
+
+class Registry():
+    """
+    Process-wide cache of loaded models.
+
+    Models are keyed by the resolved path of their weights and the backend
+    used to load them, every holder calls acquire once and release once,
+    the model is freed when the last holder releases it.
+
+    The backend used when none is given can be set with set_default_backend
+    or with the HRL_POLICY_BACKEND environment variable, the latter is
+    inherited by the workers of SubprocVecEnv.
+    """
+    def __init__(self):
+        self._models = {}
+        self._counts = {}
+        self._loaders = {}
+        self._default_backend = None
+
+    @property
+    def default_backend(self):
+        if self._default_backend is not None:
+            return self._default_backend
+        return os.environ.get('HRL_POLICY_BACKEND','tf')
+
+    def set_default_backend(self,backend):
+        self._default_backend = backend
+
+    def register_loader(self,backend,loader,closer=None):
+        """
+        backend:    name used to select the loader in acquire
+        loader:     function that receives the path of the weights and
+                    returns an object with a predict method
+        closer:     function that frees the resources of the model, it
+                    is called when the last holder releases it
+        """
+        self._loaders[backend] = (loader,closer)
+
+    def _key(self,weights,backend):
+        return (os.path.realpath(weights),backend)
+
+    def acquire(self,weights,backend=None):
+        if backend is None: backend = self.default_backend
+        key = self._key(weights,backend)
+        if key not in self._models:
+            if backend not in self._loaders:
+                raise ValueError("Backend %s not registered" % backend)
+            loader,_ = self._loaders[backend]
+            self._models[key] = loader(weights)
+            self._counts[key] = 0
+        self._counts[key] += 1
+        return self._models[key]
+
+    def release(self,weights,backend=None):
+        if backend is None: backend = self.default_backend
+        key = self._key(weights,backend)
+        if key not in self._counts:
+            return
+        self._counts[key] -= 1
+        if self._counts[key] <= 0:
+            model = self._models.pop(key)
+            del self._counts[key]
+            _,closer = self._loaders[backend]
+            if closer is not None:
+                closer(model)
+
+    def count(self,weights,backend=None):
+        if backend is None: backend = self.default_backend
+        return self._counts.get(self._key(weights,backend),0)
+
+    def __len__(self):
+        return len(self._models)
+
+
+registry = Registry()
+registry.register_loader('tf',_load_ppo2,_close_ppo2)
+registry.register_loader('graph',_load_graph,_close_graph)
+registry.register_loader('numpy',_load_numpy)
+registry.register_loader('float16',_load_quantized('float16'))
+registry.register_loader('int8',_load_quantized('int8'))
+registry.register_loader('mmap',_load_mapped)
+registry.register_loader('server',_load_remote)
@@ -0,0 +1,246 @@
+import multiprocessing as mp
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing.connection import Listener, Client, wait
+
+import numpy as np
+
+from hrl.policies.registry import registry
+
+
+def get_default_address():
+    return os.path.join(tempfile.gettempdir(),
+            'hrl_inference_%i.sock' % os.getpid())
+
+
+class InferenceServer():
+    """
+    Hosts the models of a hierarchy once and answers the predict requests
+    of every worker sent through a unix socket, requests arriving at the
+    same time for the same weights are run as one batch
+
+    address:    path of the unix socket
+    backend:    backend of the registry used to load the models
+    batch_wait: seconds to wait for more requests once the first one
+                arrives, higher values make bigger batches
+    """
+    def __init__(self,address,backend='numpy',batch_wait=0.001):
+        self.address = address
+        self.backend = backend
+        self.batch_wait = batch_wait
+        self.batches = 0
+        self.requests = 0
+        self._connections = []
+        self._lock = threading.Lock()
+        self._models = {}
+
+    def _accept(self,listener):
+        while True:
+            conn = listener.accept()
+            with self._lock:
+                self._connections.append(conn)
+
+    def _get_model(self,weights):
+        if weights not in self._models:
+            self._models[weights] = registry.acquire(weights,self.backend)
+        return self._models[weights]
+
+    def _receive(self,ready):
+        requests = []
+        for conn in ready:
+            try:
+                weights,obs,deterministic = conn.recv()
+            except (EOFError,OSError):
+                with self._lock:
+                    self._connections.remove(conn)
+                continue
+            requests.append((conn,weights,np.asarray(obs),deterministic))
+        return requests
+
+    def _run(self,requests):
+        groups = {}
+        for request in requests:
+            _,weights,_,deterministic = request
+            groups.setdefault((weights,deterministic),[]).append(request)
+
+        for (weights,deterministic),group in groups.items():
+            try:
+                model = self._get_model(weights)
+                # Observations are (h,w,c) or batches of them
+                batch = np.concatenate([obs.reshape((-1,) + obs.shape[-3:]) \
+                        for _,_,obs,_ in group])
+                actions,_ = model.predict(batch,deterministic=deterministic)
+            except Exception as e:
+                # The workers raise it, the server keeps serving the others
+                for conn,_,_,_ in group:
+                    self._send(conn,(False,e))
+                continue
+            self.batches += 1
+
+            start = 0
+            for conn,_,obs,_ in group:
+                end = start + (len(obs) if obs.ndim == 4 else 1)
+                self._send(conn,(True,actions[start:end] if obs.ndim == 4 else actions[start]))
+                start = end
+
+    def _send(self,conn,message):
+        try:
+            try:
+                conn.send(message)
+            except (TypeError,AttributeError,ValueError) as e:
+                # The exception could not be pickled
+                if message[0]:
+                    raise
+                conn.send((False,RuntimeError(repr(message[1]))))
+        except (EOFError,OSError):
+            with self._lock:
+                if conn in self._connections:
+                    self._connections.remove(conn)
+
+    def serve(self):
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        listener = Listener(self.address,family='AF_UNIX')
+        thread = threading.Thread(target=self._accept,args=(listener,),daemon=True)
+        thread.start()
+        try:
+            self._serve()
+        finally:
+            listener.close()
+            if os.path.exists(self.address):
+                os.remove(self.address)
+
+    def _serve(self):
+        while True:
+            with self._lock:
+                connections = list(self._connections)
+            if len(connections) == 0:
+                time.sleep(0.01)
+                continue
+            ready = wait(connections,timeout=0.1)
+            if len(ready) == 0:
+                continue
+            if self.batch_wait > 0:
+                time.sleep(self.batch_wait)
+                ready = wait(connections,timeout=0)
+            requests = self._receive(ready)
+            self.requests += len(requests)
+            self._run(requests)
+
+
+def _serve(address,backend,batch_wait):
+    # terminate() sends SIGTERM, exiting normally removes the socket
+    signal.signal(signal.SIGTERM,lambda signum,frame: sys.exit(0))
+    InferenceServer(address,backend=backend,batch_wait=batch_wait).serve()
+
+
+def start_server(address=None,backend='numpy',batch_wait=0.001):
+    """
+    Starts the server in a new process and sets the environment variables
+    so every process created afterwards (e.g. the workers of SubprocVecEnv)
+    uses it, returns the process and the address
+    """
+    if address is None:
+        address = get_default_address()
+    ctx = mp.get_context('spawn')
+    process = ctx.Process(
+            target=_serve,
+            args=(address,backend,batch_wait),
+            daemon=True)
+    process.start()
+
+    # Wait until the socket exists
+    while not os.path.exists(address):
+        if not process.is_alive():
+            raise RuntimeError("The inference server did not start")
+        time.sleep(0.01)
+
+    os.environ['HRL_INFERENCE_SERVER'] = address
+    os.environ['HRL_INFERENCE_SERVER_PID'] = str(process.pid)
+    os.environ['HRL_POLICY_BACKEND'] = 'server'
+    return process, address
+
+
+def stop_server(process,address):
+    """
+    Stops the server started with start_server and removes its socket
+    """
+    process.terminate()
+    process.join(timeout=5)
+    if os.path.exists(address):
+        os.remove(address)
+    for name in ['HRL_INFERENCE_SERVER','HRL_INFERENCE_SERVER_PID']:
+        os.environ.pop(name,None)
+    if os.environ.get('HRL_POLICY_BACKEND') == 'server':
+        del os.environ['HRL_POLICY_BACKEND']
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid,0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+_connections = {}
+
+def _get_connection(address):
+    # One connection per process, a forked worker opens its own
+    key = (address,os.getpid())
+    if key not in _connections:
+        _connections[key] = Client(address,family='AF_UNIX')
+    return _connections[key]
+
+
+class RemoteModel():
+    """
+    Same predict interface as PPO2, the prediction is done by the
+    InferenceServer listening in address. The errors of the server are
+    raised by predict, which also raises if the server dies or does not
+    answer in timeout seconds
+
+    timeout:    seconds to wait for an answer, None waits while the
+                server is alive
+    """
+    def __init__(self,weights,address=None,timeout=300):
+        self.weights = os.path.realpath(weights)
+        if address is None:
+            address = os.environ['HRL_INFERENCE_SERVER']
+        self.address = address
+        self.timeout = timeout
+        pid = os.environ.get('HRL_INFERENCE_SERVER_PID')
+        self.server_pid = int(pid) if pid is not None else None
+
+    def _wait(self,conn):
+        start = time.time()
+        while not conn.poll(1.0):
+            if self.server_pid is not None and not _is_alive(self.server_pid):
+                raise RuntimeError("The inference server in %s died" % self.address)
+            if self.timeout is not None and time.time() - start > self.timeout:
+                raise TimeoutError("The inference server in %s did not answer in %is" \
+                        % (self.address,self.timeout))
+
+    def predict(self,observation,state=None,mask=None,deterministic=False):
+        conn = _get_connection(self.address)
+        try:
+            conn.send((self.weights,np.asarray(observation),deterministic))
+            self._wait(conn)
+            ok, result = conn.recv()
+        except (EOFError,OSError,RuntimeError,TimeoutError) as e:
+            # A late answer would be read by the next request
+            _connections.pop((self.address,os.getpid()),None)
+            conn.close()
+            if isinstance(e,(EOFError,OSError)):
+                raise RuntimeError("The inference server in %s closed the connection" \
+                        % self.address)
+            raise
+        if not ok:
+            raise result
+        return result, None
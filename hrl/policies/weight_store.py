@@ -0,0 +1,88 @@
+import json
+import os
+
+import numpy as np
+
+from hrl.policies.numpy_policy import NumpyCnnPolicy
+
+# Offsets are aligned to 64 bytes (16 float32) so every array starts in
+# its own cache line
+ALIGNMENT = 16
+
+
+def get_store_paths(weights):
+    """
+    hrl/weights/X/v1.1.pkl -> hrl/weights/X/v1.1.npy, hrl/weights/X/v1.1.json
+    """
+    name = os.path.splitext(weights)[0]
+    return name + '.npy', name + '.json'
+
+
+def convert_to_store(weights):
+    """
+    Writes the parameters of the checkpoint in a single flat float32 array
+    (the arena) plus a manifest with the offset and shape of each of them
+    """
+    model = NumpyCnnPolicy.load(weights)
+    arrays = dict(model.params)
+    manifest = {
+            'observation_shape': list(model.observation_shape),
+            'params': {},
+            }
+    for key in ['low','scale']:
+        val = np.asarray(getattr(model,key),dtype=np.float32)
+        if val.ndim == 0:
+            manifest[key] = float(val)
+        else:
+            arrays['obs/' + key] = val
+
+    offset = 0
+    entries = {}
+    for name,p in arrays.items():
+        entries[name] = {'offset': offset, 'shape': list(p.shape)}
+        offset += -(-p.size // ALIGNMENT) * ALIGNMENT
+    manifest['params'] = entries
+    manifest['size'] = offset
+
+    arena_path, manifest_path = get_store_paths(weights)
+    arena = np.lib.format.open_memmap(
+            arena_path,mode='w+',dtype=np.float32,shape=(offset,))
+    for name,p in arrays.items():
+        start = entries[name]['offset']
+        arena[start:start+p.size] = p.reshape(-1)
+    arena.flush()
+    del arena
+
+    with open(manifest_path,'w') as f:
+        json.dump(manifest,f,indent=1)
+    return arena_path, manifest_path
+
+
+def load_mapped(weights):
+    """
+    Returns a NumpyCnnPolicy whose parameters are read only views of the
+    memory mapped arena, every process mapping the same file shares one
+    copy of the weights through the page cache
+    """
+    arena_path, manifest_path = get_store_paths(weights)
+    if not os.path.isfile(manifest_path):
+        raise IOError("%s not found, convert the weights first with \
+                python hrl/common/convert_weights.py --mmap -w %s" \
+                % (manifest_path,weights))
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    arena = np.load(arena_path,mmap_mode='r')
+
+    params = {}
+    for name,entry in manifest['params'].items():
+        size = int(np.prod(entry['shape']))
+        start = entry['offset']
+        params[name] = arena[start:start+size].reshape(entry['shape'])
+
+    low = params.pop('obs/low',manifest.get('low'))
+    scale = params.pop('obs/scale',manifest.get('scale'))
+    return NumpyCnnPolicy(params,
+            manifest['observation_shape'],
+            low=np.float32(low) if np.isscalar(low) else low,
+            scale=np.float32(scale) if np.isscalar(scale) else scale)